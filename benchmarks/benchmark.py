@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Times plugin functions on synthetic images with headless GEGL.
+No running GIMP needed, but its typelibs and bszgw.py still have to be around
+since the plugins import them.
+
+Each case runs in its own process so peak RSS belongs to that case alone.
+Results are printed, or written with --output, as a JSON list like
+[{"case": "dual_bloom", "megapixels": 10, "format": "rgba",
+  "seconds": 1.2, "mp_per_s": 8.3, "peak_rss_mb": 812.5}, ...]
+
+$ python3 benchmarks/benchmark.py --sizes 1 10 --cases dual_bloom lightgrain
+"""
+
+import gi
+gi.require_version('Gegl', '0.4')
+from gi.repository import Gegl
+import argparse
+import json
+import math
+import os.path
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT)
+
+# babl formats of the synthetic images
+FORMATS = {
+    "rgba": "R'G'B'A u8",
+    "gray": "Y'A u8",
+}
+
+
+# case name: (plugin file, param overrides by name, module overrides)
+# Overrides pick the code path to time. Module overrides replace globals,
+# so the FFI plugins can be timed on each of their fallbacks too.
+CASES = {
+    # {{{
+    "dual_bloom": ("bsz-dualbloom/bsz-dualbloom.py", {}, {}),
+    "dual_bloom_split": ("bsz-dualbloom/bsz-dualbloom.py",
+                         {"Blur Size Low": 4}, {}),
+    "dual_bloom_fast": ("bsz-dualbloom/bsz-dualbloom.py",
+                        {"Blur Mode": "fast"}, {}),
+    "dual_bloom_2": ("bsz-dualbloom2/bsz-dualbloom2.py", {}, {}),
+    "filmic_chroma_gegl": ("bsz-filmic-chroma/bsz-filmic-chroma.py",
+                           {"Backend": "gegl"}, {}),
+    "filmic_chroma_ffi": ("bsz-filmic-chroma/bsz-filmic-chroma.py",
+                          {"Precision": "double"}, {}),
+    "filmic_chroma_ffi_f32": ("bsz-filmic-chroma/bsz-filmic-chroma.py",
+                              {"Precision": "float", "Backend": "library"},
+                              {}),
+    "filmic_chroma_numpy": ("bsz-filmic-chroma/bsz-filmic-chroma.py",
+                            {"Precision": "double"}, {"FFI": False}),
+    "filmic_chroma_struct": ("bsz-filmic-chroma/bsz-filmic-chroma.py",
+                             {"Precision": "double"},
+                             {"FFI": False, "numpy": None}),
+    "lightgrain": ("bsz-lightgrain/bsz-lightgrain.py", {}, {}),
+    "pixel_math": ("bsz-pixel-math/bsz-pixel-math.py", {}, {}),
+    "pixel_math_tiled": ("bsz-pixel-math/bsz-pixel-math.py",
+                         {"Tiled": True}, {}),
+    "pixel_math_numpy": ("bsz-pixel-math/bsz-pixel-math.py", {
+        "Backend": "numpy",
+        "Code": "pixels[..., 2] = 1 - pixels[..., 2]"}, {}),
+    "pixelbuster": ("bsz-pixelbuster/bsz-pixelbuster.py", {}, {}),
+    # }}}
+}
+
+
+def make_buffer(megapixels: float, babl_format: str):
+    # {{{
+    """Returns a roughly 4:3 buffer of about `megapixels`, filled with a
+diagonal gradient under colored noise so thresholds and blurs all have
+something to do. Seeded, so every run gets the same image."""
+    width = round(math.sqrt(megapixels * 1e6 * 4 / 3))
+    height = round(megapixels * 1e6 / width)
+    buffer = Gegl.Buffer.new(babl_format, 0, 0, width, height)
+
+    tree = Gegl.Node()
+    Gradient = tree.create_child("gegl:linear-gradient")
+    Gradient.set_property("end-x", width)
+    Gradient.set_property("end-y", height)
+    Crop = tree.create_child("gegl:crop")
+    Crop.set_property("width", width)
+    Crop.set_property("height", height)
+    Noise = tree.create_child("gegl:noise-rgb")
+    Noise.set_property("independent", True)
+    Noise.set_property("seed", 1)
+    Output = tree.create_child("gegl:write-buffer")
+    Output.set_property("buffer", buffer)
+    Gradient.link(Crop)
+    Crop.link(Noise)
+    Noise.link(Output)
+    Output.process()
+    return buffer
+    # }}}
+
+
+def run_case(case: str, megapixels: float, image_format: str):
+    # {{{
+    """Runs one case in this process and returns its result dict."""
+    from bsz_gimp_lib import GeglDrawable
+    from bsz_gimp_batch import load_plugin
+    path, overrides, module_overrides = CASES[case]
+    module = load_plugin(os.path.join(ROOT, path))
+    for key, value in module_overrides.items():
+        setattr(module, key, value)
+    plugin = module.plugin
+    values = plugin.values(overrides)
+
+    Gegl.init(None)
+    drawable = GeglDrawable(make_buffer(megapixels, FORMATS[image_format]))
+    x, y, width, height = drawable.mask_intersect()[1:]
+
+    start = time.perf_counter()
+    plugin.function(None, drawable, *values)
+    seconds = time.perf_counter() - start
+
+    # KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss /= 1024
+    return {
+        "case": case,
+        "megapixels": megapixels,
+        "format": image_format,
+        "width": width,
+        "height": height,
+        "seconds": seconds,
+        "mp_per_s": width * height / 1e6 / seconds,
+        "peak_rss_mb": rss / 1024,
+    }
+    # }}}
+
+
+def main():
+    # {{{
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--cases", nargs="+", choices=CASES,
+                        default=list(CASES))
+    parser.add_argument("--sizes", nargs="+", type=float, default=[1, 10, 50],
+                        help="Image sizes in megapixels")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS,
+                        default=["rgba"])
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Seconds before a case is given up on")
+    parser.add_argument("--output", help="JSON file to write instead of "
+                        "printing")
+    # internal, runs a single case in this process
+    parser.add_argument("--run", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        case, megapixels, image_format = args.run
+        print(json.dumps(run_case(case, float(megapixels), image_format)))
+        return
+
+    results = []
+    for case in args.cases:
+        for megapixels in args.sizes:
+            for image_format in args.formats:
+                command = [sys.executable, os.path.realpath(__file__),
+                           "--run", case, str(megapixels), image_format]
+                try:
+                    done = subprocess.run(command, capture_output=True,
+                                          text=True, timeout=args.timeout)
+                except subprocess.TimeoutExpired:
+                    result = {"error": "timed out"}
+                else:
+                    # plugins print their fallbacks, so the result's last
+                    lines = done.stdout.strip().splitlines()
+                    if done.returncode == 0 and lines:
+                        result = json.loads(lines[-1])
+                    else:
+                        errors = done.stderr.strip().splitlines()
+                        result = {"error": errors[-1] if errors
+                                  else "failed"}
+                result = {"case": case, "megapixels": megapixels,
+                          "format": image_format, **result}
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    # }}}
+
+
+if __name__ == "__main__":
+    main()
@@ -30,90 +30,242 @@ import sys
 import os.path
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
 from bsz_gimp_lib import PlugIn, ParamNumber, ParamNumberChain, \
-    ParamCombo, GEGL_COMPOSITORS
+    ParamCombo, GEGL_COMPOSITORS, GeglSpec, Bind
 
 
-# Main function.
-def dual_bloom(self, drawable, thresh_high, thresh_low,
-               size_high, size_low, opacity_high, opacity_low,
-               composite_high="gegl:overlay", composite_low="gegl:overlay"):
+# Fast blurs are done at this size on a downscaled copy
+FAST_SIZE = 8
+
+
+# Blur size is the % of the longest selection side/2,
+# capped at the maximum size Gaussian Blur supports.
+# Fast mode never blurs that big so it goes uncapped.
+def blur_size(size, mode, rect):
+    x, y, width, height = rect
+    size = (max(width, height) / 2 * size) / 100
+    if mode == "fast":
+        return size
+    return min(1500, size)
+
+
+# How much fast mode downscales the mask, 1 for exact or small blurs
+def blur_ratio(size, mode, rect):
+    size = blur_size(size, mode, rect)
+    if mode == "fast" and size > FAST_SIZE:
+        return FAST_SIZE / size
+    return 1
+
+
+def scaled_size(size, mode, rect):
+    return blur_size(size, mode, rect) * blur_ratio(size, mode, rect)
+
+
+def inverse_ratio(size, mode, rect):
+    return 1 / blur_ratio(size, mode, rect)
+
+
+# Binds for a pyramid blur of the given size param.
+# Downscales, blurs at the reduced size, then upscales back.
+def pyramid(size):
     # {{{
-    # mask_intersect() is the current selection mask
-    intersect, x, y, width, height = drawable.mask_intersect()
-    if intersect:
-        size_upper = max(width, height) / 2
-        size_high = min(1500, (size_upper * size_high) / 100)
-        size_low = min(1500, (size_upper * size_low) / 100)
-
-        # start Gegl
-        Gegl.init(None)
-        # fetch main buffer
-        buff = drawable.get_buffer()
-        # fetch shadow aka "temp" buffer
-        shadow = drawable.get_shadow_buffer()
-        # create a new node tree/graph
-        tree = Gegl.Node()
-
-        # Input buffer node using main buffer
-        Input = tree.create_child("gegl:buffer-source")
-        Input.set_property("buffer", buff)
-
-        # Filter nodes for high threshold. See gegl.org/operations
-        Threshold_High = tree.create_child("gegl:threshold")
-        Threshold_High.set_property("value", thresh_high)
-        Blur_High = tree.create_child("gegl:gaussian-blur")
-        Blur_High.set_property("std-dev-x", size_high)
-        Blur_High.set_property("std-dev-y", size_high)
-        Opacity_High = tree.create_child("gegl:opacity")
-        Opacity_High.set_property("value", opacity_high)
-        Comp_High = tree.create_child(composite_high)
+    params = (size, "Blur Mode")
+    return {
+        "Down": ("gegl:scale-ratio", {
+            "x": Bind(params, blur_ratio),
+            "y": Bind(params, blur_ratio)}),
+        "Blur": ("gegl:gaussian-blur", {
+            "std-dev-x": Bind(params, scaled_size),
+            "std-dev-y": Bind(params, scaled_size)}),
+        "Up": ("gegl:scale-ratio", {
+            "x": Bind(params, inverse_ratio),
+            "y": Bind(params, inverse_ratio)}),
+    }
+    # }}}
+
+
+# both graphs are called with these, in order
+PARAMS = ("Threshold High", "Threshold Low", "Blur Size High", "Blur Size Low",
+          "Opacity High", "Opacity Low", "Composite High", "Composite Low",
+          "Blur Mode")
+
+
+# Graph with a blur for each bloom. See gegl.org/operations
+# Opacity comes after the blur, which gives the same result since both are
+# linear, but then changing opacity only redoes the composite.
+dual_bloom_split = GeglSpec(
+    nodes={
+        # {{{
+        # Filter nodes for high threshold
+        "Threshold_High": ("gegl:threshold", {
+            "value": Bind("Threshold High")}),
+        "Mask_High": ("gegl:opacity", {}),
+        **{key + "_High": node
+           for key, node in pyramid("Blur Size High").items()},
+        "Opacity_High": ("gegl:opacity", {"value": Bind("Opacity High")}),
+        "Comp_High": (Bind("Composite High"), {}),
 
         # Filter nodes for low threshold
-        Threshold_Low = tree.create_child("gegl:threshold")
-        Threshold_Low.set_property("value", thresh_low)
-        Invert = tree.create_child("gegl:value-invert")
-        Blur_Low = tree.create_child("gegl:gaussian-blur")
-        Blur_Low.set_property("std-dev-x", size_low)
-        Blur_Low.set_property("std-dev-y", size_low)
-        Opacity_Low = tree.create_child("gegl:opacity")
-        Opacity_Low.set_property("value", opacity_low)
-        Comp_Low = tree.create_child(composite_low)
-
-        # Output buffer node using temp buffer
-        Output = tree.create_child("gegl:write-buffer")
-        Output.set_property("buffer", shadow)
+        "Threshold_Low": ("gegl:threshold", {
+            "value": Bind("Threshold Low")}),
+        "Invert": ("gegl:value-invert", {}),
+        "Mask_Low": ("gegl:opacity", {}),
+        **{key + "_Low": node
+           for key, node in pyramid("Blur Size Low").items()},
+        "Opacity_Low": ("gegl:opacity", {"value": Bind("Opacity Low")}),
+        "Comp_Low": (Bind("Composite Low"), {}),
+        # }}}
+    },
+    links=(
+        # {{{
+        # base image linked to node inputs
+        ("Input", "Threshold_High"),
+        ("Input", "Threshold_Low"),
+        ("Input", "Comp_Low"),
 
+        # low bloom is the threshold masked by its inverse
+        ("Threshold_Low", "Invert"),
+        ("Threshold_Low", "Mask_Low"),
+        ("Invert", "Mask_Low", "aux"),
+        ("Mask_Low", "Down_Low"),
+        ("Down_Low", "Blur_Low"),
+        ("Blur_Low", "Up_Low"),
+        ("Up_Low", "Opacity_Low"),
+        ("Opacity_Low", "Comp_Low", "aux"),
+        ("Comp_Low", "Comp_High"),
+
+        # high bloom is the threshold masked by itself
+        ("Threshold_High", "Mask_High"),
+        ("Threshold_High", "Mask_High", "aux"),
+        ("Mask_High", "Down_High"),
+        ("Down_High", "Blur_High"),
+        ("Blur_High", "Up_High"),
+        ("Up_High", "Opacity_High"),
+        ("Opacity_High", "Comp_High", "aux"),
+        ("Comp_High", "Output"),
+        # }}}
+    ),
+    params=PARAMS,
+    name="dual_bloom_split",
+)
+
+
+# Graph for equal blur sizes, which is the default with Link Blurs.
+# Both blooms' coverage is packed into the red and green of one opaque
+# buffer, blurred once, then unpacked as alpha over white and black.
+# Colors are infinite, so everything they touch is cropped to the input.
+dual_bloom_fused = GeglSpec(
+    nodes={
+        # {{{
+        # Same masks as the split graph, the low one made white
+        "Threshold_High": ("gegl:threshold", {
+            "value": Bind("Threshold High")}),
+        "Mask_High": ("gegl:opacity", {}),
+        "Threshold_Low": ("gegl:threshold", {
+            "value": Bind("Threshold Low")}),
+        "Invert": ("gegl:value-invert", {}),
+        "Mask_Low": ("gegl:opacity", {}),
+
+        # Flattened to coverage, tinted, and added into one buffer
+        "Black": ("gegl:color", {}),
+        "White": ("gegl:color", {"value": lambda: Gegl.Color.new("#fff")}),
+        "Red": ("gegl:color", {"value": lambda: Gegl.Color.new("#f00")}),
+        "Green": ("gegl:color", {"value": lambda: Gegl.Color.new("#0f0")}),
+        "Cover_High": ("gegl:over", {}),
+        "Cover_Low": ("gegl:over", {}),
+        "Tint_High": ("gegl:multiply", {}),
+        "Tint_Low": ("gegl:multiply", {}),
+        "Pack": ("gegl:add", {}),
+        "Crop_Pack": ("gegl:crop", {}),
+
+        **pyramid("Blur Size High"),
+
+        # Blur fades the edges out, so flatten again before unpacking
+        "Flatten": ("gegl:over", {}),
+        "Extract_High": ("gegl:component-extract", {
+            "component": "rgb-r", "linear": True}),
+        "Extract_Low": ("gegl:component-extract", {
+            "component": "rgb-g", "linear": True}),
+        "Bloom_High": ("gegl:opacity", {}),
+        "Bloom_Low": ("gegl:opacity", {}),
+        "Crop_High": ("gegl:crop", {}),
+        "Crop_Low": ("gegl:crop", {}),
+
+        "Opacity_High": ("gegl:opacity", {"value": Bind("Opacity High")}),
+        "Comp_High": (Bind("Composite High"), {}),
+        "Opacity_Low": ("gegl:opacity", {"value": Bind("Opacity Low")}),
+        "Comp_Low": (Bind("Composite Low"), {}),
+        # }}}
+    },
+    links=(
+        # {{{
         # base image linked to node inputs
-        Input.link(Threshold_High)
-        Input.link(Threshold_Low)
-        Input.link(Comp_Low)
-
-        # Link/connect rest of nodes
-        Threshold_Low.link(Invert)
-        Threshold_Low.link(Opacity_Low)
-        # .link(node) is shorthand for .connect_to("output", node, "input")
-        Invert.connect_to("output", Opacity_Low, "aux")
-        Opacity_Low.link(Blur_Low)
-        Blur_Low.connect_to("output", Comp_Low, "aux")
-        Comp_Low.link(Comp_High)
-
-        Threshold_High.link(Opacity_High)
-        Threshold_High.connect_to("output", Opacity_High, "aux")
-        Opacity_High.link(Blur_High)
-        Blur_High.connect_to("output", Comp_High, "aux")
-        Comp_High.link(Output)
-
-        # Run the node tree
-        Output.process()
-
-        # Flush shadow buffer and combine it with main drawable
-        shadow.flush()
-        drawable.merge_shadow(True)
-
-        # Update everything.
-        drawable.update(x, y, width, height)
-        Gimp.displays_flush()
+        ("Input", "Threshold_High"),
+        ("Input", "Threshold_Low"),
+        ("Input", "Comp_Low"),
+        # crops with aux take its bounds
+        ("Input", "Crop_Pack", "aux"),
+        ("Input", "Crop_High", "aux"),
+        ("Input", "Crop_Low", "aux"),
+
+        ("Threshold_High", "Mask_High"),
+        ("Threshold_High", "Mask_High", "aux"),
+        ("Threshold_Low", "Invert"),
+        ("Invert", "Mask_Low"),
+        ("Invert", "Mask_Low", "aux"),
+
+        # pack
+        ("Black", "Cover_High"),
+        ("Mask_High", "Cover_High", "aux"),
+        ("Black", "Cover_Low"),
+        ("Mask_Low", "Cover_Low", "aux"),
+        ("Cover_High", "Tint_High"),
+        ("Red", "Tint_High", "aux"),
+        ("Cover_Low", "Tint_Low"),
+        ("Green", "Tint_Low", "aux"),
+        ("Tint_High", "Pack"),
+        ("Tint_Low", "Pack", "aux"),
+        ("Pack", "Crop_Pack"),
+        ("Crop_Pack", "Down"),
+        ("Down", "Blur"),
+        ("Blur", "Up"),
+
+        # unpack
+        ("Black", "Flatten"),
+        ("Up", "Flatten", "aux"),
+        ("Flatten", "Extract_High"),
+        ("Flatten", "Extract_Low"),
+        ("White", "Bloom_High"),
+        ("Extract_High", "Bloom_High", "aux"),
+        ("Black", "Bloom_Low"),
+        ("Extract_Low", "Bloom_Low", "aux"),
+        ("Bloom_High", "Crop_High"),
+        ("Bloom_Low", "Crop_Low"),
+
+        # composite like the split graph
+        ("Crop_Low", "Opacity_Low"),
+        ("Opacity_Low", "Comp_Low", "aux"),
+        ("Comp_Low", "Comp_High"),
+        ("Crop_High", "Opacity_High"),
+        ("Opacity_High", "Comp_High", "aux"),
+        ("Comp_High", "Output"),
         # }}}
+    ),
+    params=PARAMS,
+    name="dual_bloom_fused",
+)
+
+
+# Main function. Equal sizes only need the one blur.
+def dual_bloom(image, drawable, thresh_high, thresh_low,
+               size_high, size_low, *params):
+    # {{{
+    if size_high == size_low:
+        graph = dual_bloom_fused
+    else:
+        graph = dual_bloom_split
+    graph(image, drawable, thresh_high, thresh_low,
+          size_high, size_low, *params)
+    # }}}
 
 
 # Parameters from bsz_gimp_lib
@@ -126,7 +278,8 @@ thresh_low = ParamNumber("Threshold Low", 0.30, 0, 1,
                          ui_step=0.1, ui_column=1)
 
 blur_desc = "Blur size is the % of the longest selection side/2. \
-Capped internally at 1500, the maximum size Gaussian Blur supports."
+Capped internally at 1500, the maximum size Gaussian Blur supports, \
+unless Blur Mode is Fast."
 size_high = ParamNumber("Blur Size High", 2, 0, 100, blur_desc,
                         ui_logarithmic=True)
 size_low = ParamNumber("Blur Size Low", 2, 0, 100, blur_desc,
@@ -145,6 +298,10 @@ composite_high = ParamCombo("Composite High", GEGL_COMPOSITORS, "svg:overlay",
                             composite_desc)
 composite_low = ParamCombo("Composite Low", GEGL_COMPOSITORS, "svg:overlay",
                            composite_desc, ui_column=1)
+
+blur_mode = ParamCombo("Blur Mode", {"Exact": "exact", "Fast": "fast"},
+                       "exact", "Fast approximates big blurs by blurring \
+a downscaled copy, which is much quicker on large images.")
 # }}}
 
 
@@ -160,11 +317,18 @@ plugin = PlugIn(
     opacity_low,
     composite_high,
     composite_low,
+    blur_mode,
     size_chain,
     description="Provides light and dark bloom using thresholds. \
 Based on my own custom bloom methods.",
     images="RGB*, GRAY*",
+    preview_scale=(0.125, 0.5, 1),
+    # the 1/8 pass is cheap and stale passes get cancelled, so start early
+    preview_delay=0.05,
+    graphs=(dual_bloom_split, dual_bloom_fused),
 )
 
-# register the plugin's Procedure class with gimp
-Gimp.main(plugin.Procedure.__gtype__, sys.argv)
+# register the plugin's Procedure class with gimp.
+# only when run by gimp, so scripts can import the functions
+if __name__ == "__main__":
+    Gimp.main(plugin.Procedure.__gtype__, sys.argv)
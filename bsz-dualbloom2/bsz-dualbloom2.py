@@ -21,89 +21,63 @@ run python's help() on it to view it in the terminal.
 import gi
 gi.require_version('Gimp', '3.0')
 from gi.repository import Gimp
-gi.require_version('Gegl', '0.4')
-from gi.repository import Gegl
+# gi.require_version('Gegl', '0.4')
+# from gi.repository import Gegl
 # from gi.repository import GObject
 # from gi.repository import GLib
 # from gi.repository import Gio
 import sys
 import os.path
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
-from bsz_gimp_lib import PlugIn, ParamNumber, ParamNumberChain
-
-
-# Main function.
-def dual_bloom_2(image, drawable, threshold_high, threshold_low,
-                 softness_high, softness_low, radius_high, radius_low,
-                 strength_high, strength_low):
-    # {{{
-    # mask_intersect() is the current selection mask
-    intersect, x, y, width, height = drawable.mask_intersect()
-    if intersect:
-        # start Gegl
-        Gegl.init(None)
-        # fetch main buffer
-        buff = drawable.get_buffer()
-        # fetch shadow aka "temp" buffer
-        shadow = drawable.get_shadow_buffer()
-        # create a new node tree/graph
-        tree = Gegl.Node()
-
-        # Input buffer node using main buffer
-        Input = tree.create_child("gegl:buffer-source")
-        Input.set_property("buffer", buff)
+from bsz_gimp_lib import PlugIn, ParamNumber, ParamNumberChain, \
+    GeglSpec, Bind
 
+
+# Main function. See gegl.org/operations
+dual_bloom_2 = GeglSpec(
+    nodes={
+        # {{{
         # Operations for the high bloom
-        Bloom_High = tree.create_child("gegl:bloom")
-        Bloom_High.set_property("threshold", threshold_high)
-        Bloom_High.set_property("softness", softness_high)
-        Bloom_High.set_property("radius", radius_high)
-        Bloom_High.set_property("strength", strength_high)
-        Sub_High = tree.create_child("gegl:subtract")
-        Add_High = tree.create_child("gegl:add")
+        "Bloom_High": ("gegl:bloom", {
+            "threshold": Bind("Threshold High"),
+            "softness": Bind("Softness High"),
+            "radius": Bind("Radius High"),
+            "strength": Bind("Strength High")}),
+        "Sub_High": ("gegl:subtract", {}),
+        "Add_High": ("gegl:add", {}),
 
         # Operations for the low bloom
-        Invert_Low = tree.create_child("gegl:invert-gamma")
-        Bloom_Low = tree.create_child("gegl:bloom")
-        Bloom_Low.set_property("threshold", threshold_low)
-        Bloom_Low.set_property("softness", softness_low)
-        Bloom_Low.set_property("radius", radius_low)
-        Bloom_Low.set_property("strength", strength_low)
-        Invert_Low2 = tree.create_child("gegl:invert-gamma")
-
-        # Output buffer node using temp buffer
-        Output = tree.create_child("gegl:write-buffer")
-        Output.set_property("buffer", shadow)
-
+        "Invert_Low": ("gegl:invert-gamma", {}),
+        "Bloom_Low": ("gegl:bloom", {
+            "threshold": Bind("Threshold Low"),
+            "softness": Bind("Softness Low"),
+            "radius": Bind("Radius Low"),
+            "strength": Bind("Strength Low")}),
+        "Invert_Low2": ("gegl:invert-gamma", {}),
+        # }}}
+    },
+    links=(
+        # {{{
         # base image linked to node inputs
-        Input.link(Bloom_High)
-        Input.connect_to("output", Sub_High, "aux")
-        Input.link(Invert_Low)
+        ("Input", "Bloom_High"),
+        ("Input", "Sub_High", "aux"),
+        ("Input", "Invert_Low"),
 
         # High bloom nodes
-        Bloom_High.link(Sub_High)
-        Sub_High.connect_to("output", Add_High, "aux")
+        ("Bloom_High", "Sub_High"),
+        ("Sub_High", "Add_High", "aux"),
 
         # Low bloom nodes
-        Invert_Low.link(Bloom_Low)
-        Bloom_Low.link(Invert_Low2)
-        Invert_Low2.link(Add_High)
+        ("Invert_Low", "Bloom_Low"),
+        ("Bloom_Low", "Invert_Low2"),
+        ("Invert_Low2", "Add_High"),
 
         # Combine
-        Add_High.link(Output)
-
-        # Run the node tree
-        Output.process()
-
-        # Flush shadow buffer and combine it with main drawable
-        shadow.flush()
-        drawable.merge_shadow(True)
-
-        # Update everything.
-        drawable.update(x, y, width, height)
-        Gimp.displays_flush()
-
+        ("Add_High", "Output"),
         # }}}
+    ),
+    name="dual_bloom_2",
+)
 
 
 # Parameters from bsz_gimp_lib
@@ -120,9 +94,9 @@ softness_low = ParamNumber("Softness Low", 25, 0, 100, softness_desc,
 
 radius_desc = "Glow radius"
 radius_high = ParamNumber("Radius High", 10, 0, 1500, radius_desc,
-                          ui_logarithmic=True)
+                          ui_logarithmic=True, proxy_scale=True)
 radius_low = ParamNumber("Radius Low", 10, 0, 1500, radius_desc,
-                         ui_logarithmic=True, ui_column=1)
+                         ui_logarithmic=True, ui_column=1, proxy_scale=True)
 
 strength_desc = "Glow strength"
 strength_high = ParamNumber("Strength High", 50, 0, 1000, strength_desc,
@@ -153,7 +127,12 @@ plugin = PlugIn(
     description="Produces both a light and dark bloom. \
 Based on gimp/gegl's existing bloom.",
     images="RGB*, GRAY*",
+    preview_scale=(0.125, 0.5, 1),
+    # the 1/8 pass is cheap and stale passes get cancelled, so start early
+    preview_delay=0.05,
 )
 
-# register the plugin's Procedure class with gimp
-Gimp.main(plugin.Procedure.__gtype__, sys.argv)
+# register the plugin's Procedure class with gimp.
+# only when run by gimp, so scripts can import the functions
+if __name__ == "__main__":
+    Gimp.main(plugin.Procedure.__gtype__, sys.argv)
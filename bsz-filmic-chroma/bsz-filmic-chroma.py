@@ -29,28 +29,88 @@ from gi.repository import Gegl
 import sys
 import os.path
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
-from bsz_gimp_lib import PlugIn, ParamNumber, ParamBool
+from bsz_gimp_lib import PlugIn, ParamNumber, ParamBool, ParamCombo, \
+    map_buffer, process_node, apply_shadow
 
 try:
     import ctypes
     from sys import platform
     EXTENSIONS = {"win32": ".dll", "linux": ".so"}
-    FC = ctypes.CDLL(
+    FC_LIB = ctypes.CDLL(
         os.path.dirname(os.path.realpath(__file__)) +
         "/filmic_chroma" + EXTENSIONS.get(platform)
-    ).filmic_chroma
+    )
+    FC = FC_LIB.filmic_chroma
     FC.argtypes = [ctypes.c_double, ctypes.c_double, ctypes.c_bool,
-                   ctypes.c_char_p, ctypes.c_uint]
+                   ctypes.c_char_p, ctypes.c_size_t]
     FFI = True
+    # older builds don't have the single precision version
+    FC_F32 = getattr(FC_LIB, "filmic_chroma_f32", None)
+    if FC_F32 is not None:
+        FC_F32.argtypes = [ctypes.c_float, ctypes.c_float, ctypes.c_bool,
+                           ctypes.c_char_p, ctypes.c_size_t]
 except Exception as e:
     print(f"{e}\n\nFailed to load dynamic library,\
             falling back to native python implementation")
-    import struct
     FFI = False
+    FC_F32 = None
+
+# Fallbacks. NumPy is a good deal slower than the library
+# but still miles ahead of unpacking pixels one at a time with struct.
+# Always imported so benchmarks can compare them against the library
+import struct
+try:
+    import numpy
+except ImportError:
+    numpy = None
+if not FFI:
+    if numpy is not None:
+        print("Filmic Chroma using NumPy implementation")
+    else:
+        print("Filmic Chroma using pure python implementation")
+
+
+# GEGL operation built from filmic-chroma-op.c
+OPERATION = "bsz:filmic-chroma"
+OPERATION_DIR = os.path.dirname(os.path.realpath(__file__)) + "/gegl"
+
+
+def load_operation():
+    # {{{
+    """Loads the GEGL operation if it isn't already.
+Returns whether it's available. Gegl must be initialized first."""
+    if not Gegl.has_operation(OPERATION) and os.path.isdir(OPERATION_DIR):
+        Gegl.load_module_directory(OPERATION_DIR)
+    return Gegl.has_operation(OPERATION)
+    # }}}
+
+
+BACKENDS = {
+    "Auto": "auto",
+    "GEGL Operation": "gegl",
+    "Shared Library": "library",
+}
+
+PRECISIONS = {
+    "Auto": "auto",
+    "Float": "float",
+    "Double": "double",
+}
+
+# Image precisions that would lose detail going through single floats
+DOUBLE_PRECISIONS = (
+    Gimp.Precision.U32_LINEAR,
+    Gimp.Precision.U32_NON_LINEAR,
+    Gimp.Precision.U32_PERCEPTUAL,
+    Gimp.Precision.DOUBLE_LINEAR,
+    Gimp.Precision.DOUBLE_NON_LINEAR,
+    Gimp.Precision.DOUBLE_PERCEPTUAL,
+)
 
 
 # Main function.
-def filmic_chroma(image, drawable, scale, offset, invert):
+def filmic_chroma(image, drawable, scale, offset, invert, threads=0,
+                  precision="auto", backend="auto"):
     # {{{
     # Fairly certain mask_intersect() is the current selection mask
     intersect, x, y, width, height = drawable.mask_intersect()
@@ -63,47 +123,92 @@ def filmic_chroma(image, drawable, scale, offset, invert):
         # fetch shadow aka "temp" buffer
         shadow = drawable.get_shadow_buffer()
 
-        # create working rectangle area using mask intersect.
-        rect = Gegl.Rectangle.new(x, y, width, height)
-
-        # scale base of 100. Since it's divided later, it's also divided here
-        # so effect decreases with lower vals
-        scale = 100 / scale
-        offset = 1 + offset
-
-        # many times faster, but needs the shared library. I currently only
-        # have Linux and Windows devs setup, so the backup will stay for now
-        if FFI:
-            pixels = buff.get(rect, 1.0, "CIE LCH(ab) alpha double",
-                              Gegl.AbyssPolicy.CLAMP)
-            FC(scale, offset, False, pixels, len(pixels))
-            shadow.set(rect, "CIE LCH(ab) alpha double", pixels)
+        # most images are 8/16 bit or float, so doubles only waste bandwidth
+        # scripts running without GIMP have no image to ask
+        if precision == "auto":
+            double = image is not None and \
+                image.get_precision() in DOUBLE_PRECISIONS
+        else:
+            double = precision == "double"
+        # the operation only works in float
+        if backend == "auto":
+            gegl = not double
+        else:
+            gegl = backend == "gegl"
+        if gegl and load_operation():
+            # GEGL handles tiling and threading itself
+            tree = Gegl.Node()
+            Input = tree.create_child("gegl:buffer-source")
+            Input.set_property("buffer", buff)
+            Filter = tree.create_child(OPERATION)
+            Filter.set_property("scale", scale)
+            Filter.set_property("offset", offset)
+            Filter.set_property("invert", invert)
+            Output = tree.create_child("gegl:write-buffer")
+            Output.set_property("buffer", shadow)
+            Input.link(Filter)
+            Filter.link(Output)
+            # only the selection, not the whole layer
+            process_node(Output, (x, y, width, height))
 
         else:
-            pixels = buff.get(rect, 1.0, "CIE LCH(ab) alpha double",
-                              Gegl.AbyssPolicy.CLAMP)
-            # creates clusters of pixels for unpack. 32 = 8 bytes
-            pixels_iter = (pixels[x:x + 32] for x in range(0, len(pixels), 32))
-            new_pixels = bytearray()
-
-            for pixel in pixels_iter:
-                # convert 4 bytes to 4 doubles
-                l, c, h, a = struct.unpack('dddd', pixel)
-                if not invert:
-                    c *= offset - l / scale
-                else:
-                    c *= offset - (100 - l) / scale
-                new_pixels += struct.pack('dddd', l, c, h, a)
-
-            shadow.set(rect, "CIE LCH(ab) alpha double", bytes(new_pixels))
-
-        # Flush shadow buffer and combine it with main drawable
-        shadow.flush()
-        drawable.merge_shadow(True)
-
-        # Update everything.
-        drawable.update(x, y, width, height)
-        Gimp.displays_flush()
+            # scale base of 100. Since it's divided later, it's also divided here
+            # so effect decreases with lower vals
+            scale = 100 / scale
+            offset = 1 + offset
+
+            # a library without float kernels can only do doubles
+            if FFI and FC_F32 is None:
+                double = True
+
+            if double:
+                babl_format = "CIE LCH(ab) alpha double"
+                kernel = FC
+                real = 'd'
+            else:
+                babl_format = "CIE LCH(ab) alpha float"
+                kernel = FC_F32
+                real = 'f'
+
+            # many times faster, but needs the shared library. I currently only
+            # have Linux and Windows devs setup, so the backup will stay for now
+            # ctypes lets go of the GIL, so tiles can run side by side.
+            # a tile only takes about half a millisecond, too short to split
+            # the tile itself across threads
+            workers = 1
+            if FFI:
+                workers = int(threads) or os.cpu_count() or 1
+
+                def function(pixels, rect):
+                    kernel(scale, offset, invert, pixels, len(pixels))
+
+            elif numpy is not None:
+                def function(pixels, rect):
+                    # view, so the math writes straight into pixels
+                    lch = numpy.frombuffer(pixels, dtype=real).reshape(-1, 4)
+                    if not invert:
+                        lch[:, 1] *= offset - lch[:, 0] / scale
+                    else:
+                        lch[:, 1] *= offset - (100 - lch[:, 0]) / scale
+
+            else:
+                def function(pixels, rect):
+                    # 4 channels per pixel
+                    size = struct.calcsize(real)
+                    for n, (l, c, h, a) in enumerate(
+                            struct.iter_unpack(real * 4, pixels)):
+                        if not invert:
+                            c *= offset - l / scale
+                        else:
+                            c *= offset - (100 - l) / scale
+                        struct.pack_into(real, pixels, (n * 4 + 1) * size, c)
+
+            map_buffer(buff, shadow, x, y, width, height,
+                       babl_format, function, workers=workers)
+
+        # Flush shadow buffer, combine it with main drawable
+        # and update everything
+        apply_shadow(drawable, shadow, x, y, width, height)
         # }}}
 
 
@@ -116,10 +221,25 @@ plugin = PlugIn(
                 ui_step=0.1),
     ParamNumber("Offset", 0.25, 0, 1, "Flat chroma boost.", ui_step=0.1),
     ParamBool("Invert", False, "Invert lightness' effect on chroma."),
+    ParamNumber("Threads", 0, 0, max(1, os.cpu_count() or 1),
+                "Tiles the shared library backend works on at once. "
+                "0 uses every core, 1 is the old single threaded path. "
+                "The GEGL operation uses GIMP's own thread setting.",
+                integer=True),
+    ParamCombo("Precision", PRECISIONS, "auto",
+               "Float halves memory use over double. "
+               "Auto only uses double for 32 bit integer and double images."),
+    ParamCombo("Backend", BACKENDS, "auto",
+               "Auto uses the GEGL operation for float precision, "
+               "and the shared library for double. "
+               "The GEGL operation always works in float."),
     description="Reduces/increases chroma based on intensity.\n"
     "Inspired by Blender's new 'Filmic' tonemapper.",
     images="RGB*",
+    preview_delay=0.1,
 )
 
-# register the plugin's Procedure class with gimp
-Gimp.main(plugin.Procedure.__gtype__, sys.argv)
+# register the plugin's Procedure class with gimp.
+# only when run by gimp, so scripts can import the functions
+if __name__ == "__main__":
+    Gimp.main(plugin.Procedure.__gtype__, sys.argv)
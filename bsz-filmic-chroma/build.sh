@@ -5,3 +5,8 @@ strip filmic_chroma.so
 rustc --crate-type cdylib -O --target x86_64-pc-windows-gnu filmic-chroma.rs
 rm libfilmic_chroma.dll.a
 strip filmic_chroma.dll
+# GEGL operation. Own folder so GEGL doesn't try loading the libs above
+mkdir -p gegl
+cc -shared -fPIC -O2 $(pkg-config --cflags gegl-0.4) filmic-chroma-op.c \
+    -o gegl/filmic-chroma-op.so $(pkg-config --libs gegl-0.4)
+strip gegl/filmic-chroma-op.so
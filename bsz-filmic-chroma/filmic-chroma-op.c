@@ -0,0 +1,93 @@
+/* Filmic Chroma as a GEGL point filter, so it can run inside a GEGL graph
+ * and let GEGL handle tiling and threading.
+ * Same formula as filmic-chroma.rs. Loaded by bsz-filmic-chroma.py
+ * through Gegl.load_module_directory() */
+
+#include <gegl.h>
+#include <gegl-plugin.h>
+
+#ifdef GEGL_PROPERTIES
+
+property_double (scale, "Scale", 1.0)
+    description ("How much the chroma decreases with lightness.")
+    value_range (0.1, 1.0)
+
+property_double (offset, "Offset", 0.25)
+    description ("Flat chroma boost.")
+    value_range (0.0, 1.0)
+
+property_boolean (invert, "Invert", FALSE)
+    description ("Invert lightness' effect on chroma.")
+
+#else
+
+#define GEGL_OP_POINT_FILTER
+#define GEGL_OP_NAME     filmic_chroma
+#define GEGL_OP_C_SOURCE filmic-chroma-op.c
+
+#include "gegl-op.h"
+
+static void
+prepare (GeglOperation *operation)
+{
+  const Babl *space = gegl_operation_get_source_space (operation, "input");
+  const Babl *format = babl_format_with_space ("CIE LCH(ab) alpha float",
+                                               space);
+
+  gegl_operation_set_format (operation, "input", format);
+  gegl_operation_set_format (operation, "output", format);
+}
+
+static gboolean
+process (GeglOperation       *operation,
+         void                *in_buf,
+         void                *out_buf,
+         glong                n_pixels,
+         const GeglRectangle *roi,
+         gint                 level)
+{
+  GeglProperties *o = GEGL_PROPERTIES (operation);
+  gfloat *in = in_buf;
+  gfloat *out = out_buf;
+  /* scale base of 100, same as the python side */
+  gfloat scale = 100.0 / o->scale;
+  gfloat offset = 1.0 + o->offset;
+  /* pick the lightness base once instead of per pixel */
+  gfloat base = o->invert ? 100.0 : 0.0;
+  gfloat sign = o->invert ? -1.0 : 1.0;
+
+  while (n_pixels--)
+    {
+      out[0] = in[0];
+      out[1] = in[1] * (offset - (base + sign * in[0]) / scale);
+      out[2] = in[2];
+      out[3] = in[3];
+
+      in += 4;
+      out += 4;
+    }
+
+  return TRUE;
+}
+
+static void
+gegl_op_class_init (GeglOpClass *klass)
+{
+  GeglOperationClass            *operation_class;
+  GeglOperationPointFilterClass *point_filter_class;
+
+  operation_class = GEGL_OPERATION_CLASS (klass);
+  point_filter_class = GEGL_OPERATION_POINT_FILTER_CLASS (klass);
+
+  operation_class->prepare = prepare;
+  point_filter_class->process = process;
+
+  gegl_operation_class_set_keys (operation_class,
+    "name",        "bsz:filmic-chroma",
+    "title",       "Filmic Chroma",
+    "categories",  "color",
+    "description", "Reduces/increases chroma based on intensity.",
+    NULL);
+}
+
+#endif
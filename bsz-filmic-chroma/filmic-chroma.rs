@@ -1,5 +1,28 @@
+use std::ops::{Add, Div, Mul, MulAssign, Sub};
 use std::os::raw;
 
+// f32 or f64
+trait Channel: Copy + From<f32>
+    + Add<Output = Self> + Sub<Output = Self>
+    + Mul<Output = Self> + Div<Output = Self> + MulAssign {}
+impl Channel for f32 {}
+impl Channel for f64 {}
+
+fn process<T: Channel>(scale: T, offset: T, invert: bool, pixels: &mut [T]) {
+    // pick the lightness base once instead of per pixel
+    let (base, sign) = match invert {
+        false => (T::from(0.0), T::from(1.0)),
+        true => (T::from(100.0), T::from(-1.0)),
+    };
+    for pixel in pixels.chunks_exact_mut(4) {
+        pixel[1] *= offset - (base + sign * pixel[0]) / scale;
+    }
+}
+
+unsafe fn slice<'a, T>(bytes: *mut raw::c_char, len: usize) -> &'a mut [T] {
+    std::slice::from_raw_parts_mut(bytes.cast::<T>(), len / std::mem::size_of::<T>())
+}
+
 #[no_mangle]
 pub extern "C" fn filmic_chroma(
     scale: f64,
@@ -7,13 +30,16 @@ pub extern "C" fn filmic_chroma(
     invert: bool,
     bytes: *mut raw::c_char,
     len: usize) {
-    let pixels = unsafe {
-        std::slice::from_raw_parts_mut(bytes.cast::<f64>(), len/8)
-    };
-    for pixel in pixels.chunks_exact_mut(4) {
-        pixel[1] = match invert {
-            false => pixel[1] * (offset - pixel[0] / scale),
-            true => pixel[1] * (offset - (100.0 - pixel[0]) / scale)
-        };
-    };
+    process(scale, offset, invert, unsafe { slice::<f64>(bytes, len) });
+}
+
+/// filmic_chroma for "CIE LCH(ab) alpha float" pixels.
+#[no_mangle]
+pub extern "C" fn filmic_chroma_f32(
+    scale: f32,
+    offset: f32,
+    invert: bool,
+    bytes: *mut raw::c_char,
+    len: usize) {
+    process(scale, offset, invert, unsafe { slice::<f32>(bytes, len) });
 }
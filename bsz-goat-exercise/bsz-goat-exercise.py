@@ -21,8 +21,8 @@ run python's help() on it to view it in the terminal.
 import gi
 gi.require_version('Gimp', '3.0')
 from gi.repository import Gimp
-gi.require_version('Gegl', '0.4')
-from gi.repository import Gegl
+# gi.require_version('Gegl', '0.4')
+# from gi.repository import Gegl
 # from gi.repository import GObject
 # from gi.repository import GLib
 # from gi.repository import Gio
@@ -31,53 +31,27 @@ import os.path
 # add the parent folder to import search. Will let it find ../bsz_gimp_lib.py
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
 # import classes as necessary. Could also import bsz_gimp_lib as bgl if prefer.
-from bsz_gimp_lib import PlugIn, ParamNumber, ParamString
-
-
-# Main function.
-def goat_exercise(self, drawable, src_code, brightness):
-    # {{{
-    # mask_intersect() is the current selection mask
-    intersect, x, y, width, height = drawable.mask_intersect()
-    if intersect:
-        # start Gegl
-        Gegl.init(None)
-        # fetch main buffer
-        buff = drawable.get_buffer()
-        # fetch shadow aka "temp" buffer
-        shadow = drawable.get_shadow_buffer()
-        # create a new node tree/graph
-        tree = Gegl.Node()
-
-        # Input buffer node using main buffer
-        Input = tree.create_child("gegl:buffer-source")
-        Input.set_property("buffer", buff)
-
-        # Filter nodes. See gegl operation help
-        Filter_Invert = tree.create_child("gegl:invert")
-        Filter_Brightness = tree.create_child("gegl:brightness-contrast")
-        Filter_Brightness.set_property("brightness", brightness)
-
-        # Output buffer node using temp buffer
-        Output = tree.create_child("gegl:write-buffer")
-        Output.set_property("buffer", shadow)
-
-        # Connect the nodes together.
-        Input.link(Filter_Invert)
-        Filter_Invert.link(Filter_Brightness)
-        Filter_Brightness.link(Output)
-
-        # Run the node tree
-        Output.process()
-
-        # Flush shadow buffer and combine it with main drawable
-        shadow.flush()
-        drawable.merge_shadow(True)
-
-        # Update everything.
-        drawable.update(x, y, width, height)
-        Gimp.displays_flush()
-        # }}}
+from bsz_gimp_lib import PlugIn, ParamNumber, ParamString, GeglSpec, Bind
+
+
+# Main function, described as a graph instead of code.
+# GeglSpec builds it once, handles the input/output buffers, selection,
+# and merging, then only updates properties bound to params that changed.
+goat_exercise = GeglSpec(
+    # Filter nodes and their properties. See gegl operation help
+    nodes={
+        "Filter_Invert": ("gegl:invert", {}),
+        "Filter_Brightness": ("gegl:brightness-contrast", {
+            "brightness": Bind("Brightness")}),
+    },
+    # Connect the nodes together.
+    links=(
+        ("Input", "Filter_Invert"),
+        ("Filter_Invert", "Filter_Brightness"),
+        ("Filter_Brightness", "Output"),
+    ),
+    name="goat_exercise",
+)
 
 
 # Parameters from bsz_gimp_lib
@@ -116,5 +90,7 @@ plugin = PlugIn(
     path="<Image>/Filters/Development/Goat exercises/",
 )
 
-# register the plugin's Procedure class with gimp
-Gimp.main(plugin.Procedure.__gtype__, sys.argv)
+# register the plugin's Procedure class with gimp.
+# only when run by gimp, so scripts can import the functions
+if __name__ == "__main__":
+    Gimp.main(plugin.Procedure.__gtype__, sys.argv)
@@ -21,86 +21,52 @@ run python's help() on it to view it in the terminal.
 import gi
 gi.require_version('Gimp', '3.0')
 from gi.repository import Gimp
-gi.require_version('Gegl', '0.4')
-from gi.repository import Gegl
+# gi.require_version('Gegl', '0.4')
+# from gi.repository import Gegl
 # from gi.repository import GObject
 # from gi.repository import GLib
 # from gi.repository import Gio
 import sys
 import os.path
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
-from bsz_gimp_lib import PlugIn, ParamNumber, ParamBool
-
-
-# Main function.
-def lightgrain(image, drawable, dulling, noise_l, noise_c, noise_h, invert):
-    # {{{
-    # mask_intersect() is the current selection mask
-    intersect, x, y, width, height = drawable.mask_intersect()
-    if intersect:
-        # start Gegl
-        Gegl.init(None)
-        # fetch main buffer
-        buff = drawable.get_buffer()
-        # fetch shadow aka "temp" buffer
-        shadow = drawable.get_shadow_buffer()
-        # create a new node tree/graph
-        tree = Gegl.Node()
-
-        # Input buffer node using main buffer
-        Input = tree.create_child("gegl:buffer-source")
-        Input.set_property("buffer", buff)
-
-        # Operations
-        Noise = tree.create_child("gegl:noise-cie-lch")
-        Noise.set_property('holdness', dulling)
-        Noise.set_property('lightness-distance', noise_l)
-        Noise.set_property('chroma-distance', noise_c)
-        Noise.set_property('hue-distance', noise_h)
-
-        Opacity = tree.create_child("gegl:opacity")
-
-        Merge = tree.create_child("svg:src-atop")
-
-        Component = tree.create_child("gegl:component-extract")
-        Component.set_property("component", 'lab-l')
-
-        Invert = tree.create_child("gegl:invert")
-
-        # Output buffer node using temp buffer
-        Output = tree.create_child("gegl:write-buffer")
-        Output.set_property("buffer", shadow)
-
-        # base image linked to node inputs
-        Input.link(Noise)
-        Input.link(Merge)
-        Input.link(Component)
-
-        # Link/connect rest of nodes
-        Noise.link(Opacity)
-
+from bsz_gimp_lib import PlugIn, ParamNumber, ParamBool, GeglSpec, Bind
+
+
+# Main function. See gegl.org/operations
+lightgrain = GeglSpec(
+    nodes={
+        # {{{
+        "Noise": ("gegl:noise-cie-lch", {
+            'holdness': Bind("Dulling"),
+            'lightness-distance': Bind("Lightness Noise"),
+            'chroma-distance': Bind("Chroma Noise"),
+            'hue-distance': Bind("Hue Noise")}),
+        "Opacity": ("gegl:opacity", {}),
+        "Merge": ("svg:src-atop", {}),
+        "Component": ("gegl:component-extract", {"component": 'lab-l'}),
         # invert by default.
-        if not invert:
-            Component.link(Invert)
-            Invert.connect_to("output", Opacity, "aux")
         # invert option is to invert the invert aka no invert
-        else:
-            Component.connect_to("output", Opacity, "aux")
-
-        Opacity.connect_to("output", Merge, "aux")
-        Merge.link(Output)
-
-        # Run the node tree
-        Output.process()
-
-        # Flush shadow buffer and combine it with main drawable
-        shadow.flush()
-        drawable.merge_shadow(True)
+        "Invert": (Bind("Invert", lambda invert, rect:
+                        "gegl:nop" if invert else "gegl:invert"), {}),
+        # }}}
+    },
+    links=(
+        # {{{
+        # base image linked to node inputs
+        ("Input", "Noise"),
+        ("Input", "Merge"),
+        ("Input", "Component"),
 
-        # Update everything.
-        drawable.update(x, y, width, height)
-        Gimp.displays_flush()
+        # Link/connect rest of nodes
+        ("Noise", "Opacity"),
+        ("Component", "Invert"),
+        ("Invert", "Opacity", "aux"),
+        ("Opacity", "Merge", "aux"),
+        ("Merge", "Output"),
         # }}}
+    ),
+    name="lightgrain",
+)
 
 
 # create the plugin from bsz_gimp_lib
@@ -119,7 +85,10 @@ plugin = PlugIn(
     ParamBool("Invert", False),
     description="LCH Noise masked to Lightness.",
     images="RGB*, GRAY*",
+    preview_delay=0.1,
 )
 
-# register the plugin's Procedure class with gimp
-Gimp.main(plugin.Procedure.__gtype__, sys.argv)
+# register the plugin's Procedure class with gimp.
+# only when run by gimp, so scripts can import the functions
+if __name__ == "__main__":
+    Gimp.main(plugin.Procedure.__gtype__, sys.argv)
@@ -29,9 +29,20 @@ from gi.repository import Gegl
 import sys
 import os.path
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
-from bsz_gimp_lib import PlugIn, ParamCombo, ParamString, PDB
+from bsz_gimp_lib import PlugIn, ParamBool, ParamCombo, ParamNumber, \
+    ParamString, PDB, buffer_tiles, buffer_bands, map_buffer, apply_shadow, \
+    profile, import_script
 
 import struct
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 FORMATS = {
@@ -41,12 +52,124 @@ FORMATS = {
     "LCHA": "CIE LCH(ab) alpha double",
 }
 
+BACKENDS = {
+    "List": "list",
+    "NumPy": "numpy",
+}
+
+
+# Previews re-run the same code on every change, so keep it compiled.
+@lru_cache(maxsize=32)
+@profile("compile")
+def compile_code(code, babl_format, backend):
+    # {{{
+    """Returns the compiled code object. Raises SyntaxError if broken.
+Format and backend are part of the key since they change what the code
+expects 'pixels' to be."""
+    return compile(code, f"<Pixel Math {backend} {babl_format}>", "exec")
+    # }}}
+
+
+@profile("run numpy")
+def run_numpy(code, babl_format, array, namespace: dict):
+    # {{{
+    """Runs the user code on `array`, a (height, width, 4) float view of
+writable pixels, so math done in place lands straight in them.
+Code that replaces 'pixels' instead has the result copied back in."""
+    namespace["pixels"] = array
+    exec(compile_code(code, babl_format, "numpy"), globals(), namespace)
+    result = namespace["pixels"]
+    if result is not array:
+        if numpy.size(result) != array.size:
+            raise ValueError("'pixels' changed size")
+        array[...] = numpy.reshape(result, array.shape)
+    # }}}
+
+
+@profile("run code")
+def run_code(code, babl_format, backend, pixels, x, y, width, height,
+             scope: dict = None):
+    # {{{
+    """Runs the user code over one block of pixel bytes, returning new bytes.
+Module level so pool workers can run it too.
+`scope` holds more names for the code, like 'image' and 'drawable',
+which can only be given when running in this process."""
+    total = int(len(pixels) / 8)
+    # user code sees the current block's pixels and bounds
+    namespace = dict(scope or {})
+    namespace.update({
+        "x": x, "y": y,
+        "width": width, "height": height,
+    })
+    if backend == "numpy":
+        # bytes from gegl are read-only, so take one writable copy.
+        # only pool workers come through here, in process numpy runs
+        # on map_buffer's memory instead
+        memory = bytearray(pixels)
+        run_numpy(code, babl_format, numpy.frombuffer(
+            memory, dtype=numpy.float64).reshape(height, width, 4),
+            namespace)
+        pixels = bytes(memory)
+    else:
+        namespace["pixels"] = list(struct.unpack('d' * total, pixels))
+        exec(compile_code(code, babl_format, backend), globals(), namespace)
+        pixels = struct.pack('d' * total, *namespace["pixels"])
+    if len(pixels) != total * 8:
+        raise ValueError("'pixels' changed size")
+    return pixels
+    # }}}
+
+
+# Below this many pixels starting the worker processes costs more than it saves
+PARALLEL_MIN = 1000000
+POOL = None
+POOL_WORKERS = 0
+
+
+def get_pool(workers):
+    # {{{
+    """Returns a process pool with `workers` processes, reusing the last one
+when possible so previews don't pay for startup every time.
+Freed by close_pool() once the plugin's done."""
+    global POOL, POOL_WORKERS
+    if POOL is None or POOL_WORKERS != workers:
+        close_pool()
+        # fresh processes, forking after gimp and gegl's threads start
+        # isn't safe. They import this script without running Gimp.main,
+        # under the same name so run_code unpickles when it's imported
+        # by scripts like the batch runner
+        POOL = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=import_script,
+            initargs=(os.path.realpath(__file__), __name__))
+        POOL_WORKERS = workers
+    return POOL
+    # }}}
+
+
+def close_pool():
+    global POOL, POOL_WORKERS
+    if POOL is not None:
+        POOL.shutdown(cancel_futures=True)
+        POOL = None
+        POOL_WORKERS = 0
+
 
 # Main function.
-def pixel_math(image, drawable, babl_format, code):
+def pixel_math(image, drawable, babl_format, code, tiled=False,
+               backend="list", workers=1):
     # {{{
     # Fairly certain mask_intersect() is the current selection mask
     intersect, x, y, width, height = drawable.mask_intersect()
+    if backend == "numpy" and numpy is None:
+        PDB('gimp-message', "NumPy backend selected but NumPy is not installed")
+        return
+    # check the code before fetching any pixels
+    try:
+        compile_code(code, babl_format, backend)
+    except (SyntaxError, ValueError) as e:
+        PDB('gimp-message', str(e))
+        return
     if intersect:
         # start Gegl
         Gegl.init(None)
@@ -56,36 +179,85 @@ def pixel_math(image, drawable, babl_format, code):
         # fetch shadow aka "temp" buffer
         shadow = drawable.get_shadow_buffer()
 
-        # create working rectangle area using mask intersect.
-        rect = Gegl.Rectangle.new(x, y, width, height)
+        workers = int(workers)
+        pool = None
+        if tiled and workers > 1 and width * height >= PARALLEL_MIN:
+            pool = get_pool(workers)
 
-        try:
-            pixels = buff.get(rect, 1.0, babl_format,
-                              Gegl.AbyssPolicy.CLAMP)
-        # seems if babl crashes it nukes the program out of the try/except
-        # will leaves this here for now to remind myself to find a better
-        # solution
-        except Exception as e:
-            PDB('gimp-message', str(e))
-            return
+        # create working rectangle area[s] using mask intersect.
+        # tiled streams the selection in blocks so only one block's worth
+        # of python floats exists at a time.
+        # parallel uses full-width bands, a few per worker to even out load
+        if pool is not None:
+            rects = buffer_bands(buff, x, y, width, height, workers * 4)
+        elif tiled:
+            rects = buffer_tiles(buff, x, y, width, height)
+        else:
+            rects = [Gegl.Rectangle.new(x, y, width, height)]
 
+        # the whole selection whatever the block, and the names the code
+        # had before blocks. gimp's objects can't go to other processes
+        scope = {"selection": (x, y, width, height),
+                 "babl_format": babl_format}
+        local = {"image": image, "drawable": drawable}
+
+        # numpy works on a view of map_buffer's writable memory, which goes
+        # back into the shadow as is
+        if backend == "numpy" and pool is None:
+            def function(pixels, rect):
+                array = numpy.frombuffer(pixels, dtype=numpy.float64
+                                         ).reshape(rect.height, rect.width, 4)
+                namespace = {**scope, **local, "rect": rect,
+                             "x": rect.x, "y": rect.y,
+                             "width": rect.width, "height": rect.height}
+                run_numpy(code, babl_format, array, namespace)
+
+            try:
+                map_buffer(buff, shadow, x, y, width, height, babl_format,
+                           function, tiled=tiled)
+            except Exception as e:
+                PDB('gimp-message', str(e))
+                return
+            rects = []
+
+        # blocks waiting on a worker. Capped so only a couple bands per
+        # worker are held in memory at once, and set back in order.
+        pending = deque()
         try:
-            total = int(len(pixels) / 8)
-            pixels = list(struct.unpack('d' * total, pixels))
-            exec(code, globals(), locals())
-            pixels = struct.pack('d' * total, *pixels)
-        except Exception as e:
-            PDB('gimp-message', str(e))
+            for rect in rects:
+                # seems if babl crashes it nukes the program out of the
+                # try/except. will leaves this here for now to remind myself
+                # to find a better solution
+                pixels = buff.get(rect, 1.0, babl_format,
+                                  Gegl.AbyssPolicy.CLAMP)
+                args = (code, babl_format, backend, pixels,
+                        rect.x, rect.y, rect.width, rect.height)
+
+                if pool is None:
+                    shadow.set(rect, babl_format, run_code(
+                        *args, {**scope, **local, "rect": rect}))
+                else:
+                    pending.append((rect, pool.submit(run_code, *args,
+                                                      scope)))
+                    while len(pending) >= workers * 2:
+                        done, future = pending.popleft()
+                        shadow.set(done, babl_format, future.result())
 
-        shadow.set(rect, babl_format, bytes(pixels))
+            while pending:
+                done, future = pending.popleft()
+                shadow.set(done, babl_format, future.result())
 
-        # Flush shadow buffer and combine it with main drawable
-        shadow.flush()
-        drawable.merge_shadow(True)
+        except Exception as e:
+            PDB('gimp-message', str(e))
+            return
+        # also covers cancelled previews
+        finally:
+            for _, future in pending:
+                future.cancel()
 
-        # Update everything.
-        drawable.update(x, y, width, height)
-        Gimp.displays_flush()
+        # Flush shadow buffer, combine it with main drawable
+        # and update everything
+        apply_shadow(drawable, shadow, x, y, width, height)
         # }}}
 
 
@@ -103,13 +275,36 @@ plugin = PlugIn(
                 "    pixels[x:x+4] = [h, s, 1 - l, a]\n",
 
                 "Python Code to execute. "
-                "Pixels are stored as individual channels in list 'pixels'",
+                "Pixels are stored as individual channels in list 'pixels'. "
+                "'x', 'y', 'width', 'height' and 'rect' are their bounds, "
+                "'selection' is the whole selection's x, y, width, height, "
+                "and 'image' and 'drawable' are there unless using Workers",
                 ui_multiline=True,
                 ui_min_width=600, ui_min_height=200),
 
+    ParamBool("Tiled", False,
+              "Process the selection in blocks to save memory. "
+              "'pixels', 'x', 'y', 'width', 'height' and 'rect' "
+              "will describe the current block instead of the whole selection, "
+              "which stays in 'selection'"),
+
+    ParamCombo('Backend', BACKENDS, "list",
+               "How 'pixels' is given to the code. "
+               "List is a flat list of every channel. "
+               "NumPy is a float array shaped (height, width, 4) "
+               "for vectorized math, eg: pixels[..., 2] = 1 - pixels[..., 2]"),
+
+    ParamNumber("Workers", 1, 1, max(2, os.cpu_count() or 1),
+                "Processes to split large tiled selections across. "
+                "Blocks become full-width bands when above 1",
+                integer=True),
+
     description="Enter custom Python algorithms for pixel math.",
     images="RGB*, GRAY*",
+    on_close=close_pool,
 )
 
-# register the plugin's Procedure class with gimp
-Gimp.main(plugin.Procedure.__gtype__, sys.argv)
+# register the plugin's Procedure class with gimp.
+# only when run by gimp, so scripts can import the functions
+if __name__ == "__main__":
+    Gimp.main(plugin.Procedure.__gtype__, sys.argv)
@@ -31,7 +31,7 @@ import sys
 import os.path
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/../')
-from bsz_gimp_lib import PlugIn, ParamCombo, ParamString
+from bsz_gimp_lib import PlugIn, ParamString, map_buffer, apply_shadow
 
 import ctypes
 from sys import platform
@@ -66,28 +66,17 @@ def pixelbuster(image, drawable, code):
         # fetch shadow aka "temp" buffer
         shadow = drawable.get_shadow_buffer()
 
-        # create working rectangle area using mask intersect.
-        rect = Gegl.Rectangle.new(x, y, width, height)
-
-        pixels = buff.get(rect, 1.0, "RGBA float", Gegl.AbyssPolicy.CLAMP)
-
-        pb_lib.pixelbuster_ffi(
-            code.encode('UTF-8'),
-            "lrgba".encode('UTF-8'),
-            pixels,
-            len(pixels),
-            width,
-        )
-
-        shadow.set(rect, "RGBA float", bytes(pixels))
-
-        # Flush shadow buffer and combine it with main drawable
-        shadow.flush()
-        drawable.merge_shadow(True)
-
-        # Update everything.
-        drawable.update(x, y, width, height)
-        Gimp.displays_flush()
+        # run over the whole mask intersect in one go, since operations
+        # only get the row width and count rows from the start
+        source = code.encode('UTF-8')
+        map_buffer(buff, shadow, x, y, width, height, "RGBA float",
+                   lambda pixels, rect: pb_lib.pixelbuster_ffi(
+                       source, b"lrgba", pixels, len(pixels), rect.width),
+                   tiled=False)
+
+        # Flush shadow buffer, combine it with main drawable
+        # and update everything
+        apply_shadow(drawable, shadow, x, y, width, height)
         # }}}
 
 
@@ -110,5 +99,7 @@ C * v1""",
     images="*",
 )
 
-# register the plugin's Procedure class with gimp
-Gimp.main(plugin.Procedure.__gtype__, sys.argv)
+# register the plugin's Procedure class with gimp.
+# only when run by gimp, so scripts can import the functions
+if __name__ == "__main__":
+    Gimp.main(plugin.Procedure.__gtype__, sys.argv)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Runs a plugin over a directory of images without GIMP.
+Every file GEGL can load from the input directory goes through
+gegl:load -> the plugin's function -> gegl:save into the output directory,
+several at a time in separate processes.
+Params are set by name with --param, anything left out uses its default.
+
+$ python3 bsz_gimp_batch.py dualbloom --param "Blur Size High=5" in/ out/
+$ python3 bsz_gimp_batch.py filmic-chroma --params
+"""
+
+import gi
+gi.require_version('Gegl', '0.4')
+from gi.repository import Gegl
+import argparse
+import multiprocessing
+import os
+import os.path
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(ROOT)
+
+
+def find_plugin(name: str) -> str:
+    # {{{
+    """Returns the path of a plugin's script from its path, folder,
+or name with or without the bsz- prefix."""
+    candidates = [name, os.path.join(name, os.path.basename(
+        os.path.normpath(name)) + ".py")]
+    for folder in (name, "bsz-" + name):
+        candidates.append(os.path.join(ROOT, folder, folder + ".py"))
+    for path in candidates:
+        if os.path.isfile(path):
+            return os.path.realpath(path)
+    raise ValueError(f"Could not find plugin '{name}'")
+    # }}}
+
+
+def load_plugin(path: str):
+    # {{{
+    """Imports a plugin script and returns the module.
+They have dashes, so it's imported with the dashes as underscores.
+Only imports each once per process."""
+    from bsz_gimp_lib import import_script
+    name = os.path.splitext(os.path.basename(path))[0].replace("-", "_")
+    return import_script(path, name)
+    # }}}
+
+
+def parse_params(plugin, params: list) -> dict:
+    # {{{
+    """Turns "name=value" strings into values using the plugin's Params.
+Names are matched ignoring case, with dashes allowed for spaces.
+Linked params follow each other like in the dialog, so giving one sets both
+unless their chain is set false."""
+    from bsz_gimp_lib import ParamNumberChain
+    by_name = {}
+    for param in plugin.params:
+        by_name[param.name.lower()] = param
+        by_name[param.name.lower().replace(" ", "-")] = param
+    overrides = {}
+    for text in params:
+        name, sep, value = text.partition("=")
+        if not sep:
+            raise ValueError(f"Param '{text}' should be name=value")
+        param = by_name.get(name.strip().lower())
+        if param is None:
+            raise ValueError(f"{plugin.name} has no param '{name}'")
+        overrides[param.name] = param.parse(value)
+
+    for chain in plugin.params:
+        if not isinstance(chain, ParamNumberChain) or \
+                not overrides.get(chain.name, chain.value):
+            continue
+        first, second = chain.param1.name, chain.param2.name
+        if first in overrides and second in overrides:
+            if overrides[first] != overrides[second]:
+                raise ValueError(f"{first} and {second} are linked, "
+                                 f"set {chain.name}=false to give them "
+                                 "different values")
+        elif first in overrides:
+            overrides[second] = overrides[first]
+        elif second in overrides:
+            overrides[first] = overrides[second]
+    return overrides
+    # }}}
+
+
+def process_file(path: str, overrides: dict, source: str, target: str,
+                 threads: int):
+    # {{{
+    """Runs the plugin at `path` on one image. Returns seconds spent
+loading, running, and saving."""
+    from bsz_gimp_lib import GeglDrawable
+    plugin = load_plugin(path).plugin
+    Gegl.init(None)
+    if threads:
+        Gegl.config().props.threads = threads
+
+    start = time.perf_counter()
+    drawable = GeglDrawable.load(source)
+    loaded = time.perf_counter()
+    plugin.function(None, drawable, *plugin.values(overrides))
+    ran = time.perf_counter()
+    drawable.save(target)
+    saved = time.perf_counter()
+    return (loaded - start, ran - loaded, saved - ran)
+    # }}}
+
+
+def main():
+    # {{{
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n")[0],
+        epilog="Params are given as --param 'Name=value'. "
+        "Use --params to list a plugin's.")
+    parser.add_argument("plugin", help="Plugin name, folder, or script")
+    parser.add_argument("input", nargs="?", help="Folder of images to read")
+    parser.add_argument("output", nargs="?", help="Folder to write into")
+    parser.add_argument("--param", action="append", default=[],
+                        metavar="NAME=VALUE")
+    parser.add_argument("--params", action="store_true",
+                        help="List the plugin's params and exit")
+    parser.add_argument("--extension",
+                        help="Save as this type instead, eg: png")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Images to process at once")
+    args = parser.parse_args()
+
+    try:
+        path = find_plugin(args.plugin)
+        plugin = load_plugin(path).plugin
+        overrides = parse_params(plugin, args.param)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.params:
+        for param in plugin.params:
+            print(f"{param.name}={param.value!r}\n    {param.description}")
+        return
+    if not args.input or not args.output:
+        parser.error("input and output folders are required")
+
+    os.makedirs(args.output, exist_ok=True)
+    jobs = []
+    for name in sorted(os.listdir(args.input)):
+        source = os.path.join(args.input, name)
+        if not os.path.isfile(source):
+            continue
+        if args.extension:
+            name = os.path.splitext(name)[0] + "." + args.extension
+        jobs.append((source, os.path.join(args.output, name)))
+
+    # gegl already threads each image, so split the cores between jobs
+    workers = max(1, min(args.jobs, len(jobs)))
+    threads = max(1, (os.cpu_count() or 1) // workers) if workers > 1 else 0
+
+    failed = 0
+    start = time.perf_counter()
+    # fresh processes, forking after gegl's threads start isn't safe
+    with ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(process_file, path, overrides, source,
+                               target, threads): source
+                   for source, target in jobs}
+        for future in as_completed(futures):
+            source = os.path.basename(futures[future])
+            try:
+                load, run, save = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"{source}: failed, {e}", file=sys.stderr)
+            else:
+                print(f"{source}: {load + run + save:.2f}s "
+                      f"(load {load:.2f}s, run {run:.2f}s, save {save:.2f}s)")
+
+    print(f"{len(jobs) - failed}/{len(jobs)} images in "
+          f"{time.perf_counter() - start:.2f}s")
+    if failed:
+        sys.exit(1)
+    # }}}
+
+
+if __name__ == "__main__":
+    main()
@@ -29,10 +29,24 @@ sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 import bszgw
 import threading
 import time
+import ctypes
+import ctypes.util
+import weakref
+import contextlib
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
 
 
 def PDB(procedure: str, *args):
     # {{{
+    # headless there's no PDB, so messages go to the terminal instead
+    if Gimp.get_plug_in() is None:
+        if procedure == "gimp-message":
+            print(*args)
+            return None
+        raise RuntimeError(f"PDB procedure '{procedure}' needs GIMP running")
     argsv = Gimp.ValueArray.new(len(args))
     for num, arg in enumerate(args):
         if isinstance(arg, str):
@@ -51,6 +65,134 @@ def PDB(procedure: str, *args):
     # }}}
 
 
+class Profiler():
+    # {{{
+    """Adds up how long named stages take, per invocation and per dialog.
+`output` is where report() writes: "message" for gimp-message,
+"1" for stderr, or else a log file path to append to.
+Made from the BSZ_PROFILE environment variable as PROFILER, so use
+stage() and profile() instead of making these directly."""
+    def __init__(self, output: str):
+        self.output = output
+        self.lock = threading.Lock()
+        # name: [calls, total, longest]
+        self.invocation = {}
+        self.session = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        # perf_counter is monotonic
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                for stats in (self.invocation, self.session):
+                    calls, total, longest = stats.get(name, (0, 0, 0))
+                    stats[name] = (calls + 1, total + elapsed,
+                                   max(longest, elapsed))
+
+    def report(self, title: str, session: bool = False):
+        """Writes out and clears the invocation's stats,
+or the whole dialog's if `session`."""
+        with self.lock:
+            if session:
+                stats, self.session = self.session, {}
+            else:
+                stats, self.invocation = self.invocation, {}
+        if not stats:
+            return
+        width = max(len(name) for name in stats)
+        lines = [title, f"{'stage':<{width}} {'calls':>6} {'total':>9} "
+                 f"{'mean':>9} {'max':>9}"]
+        for name, (calls, total, longest) in stats.items():
+            lines.append(f"{name:<{width}} {calls:>6} {total:>9.4f} "
+                         f"{total / calls:>9.4f} {longest:>9.4f}")
+        self.write("\n".join(lines))
+
+    def write(self, text: str):
+        """Sends `text` wherever this profiler's output goes."""
+        if self.output == "message":
+            PDB("gimp-message", text)
+        elif self.output == "1":
+            print(text, file=sys.stderr)
+        else:
+            with open(self.output, "a") as f:
+                f.write(time.strftime("%Y-%m-%d %H:%M:%S ") + text + "\n\n")
+    # }}}
+
+
+# Opt-in timing of every stage. Unset or 0 is off.
+PROFILE = os.environ.get("BSZ_PROFILE", "")
+PROFILER = Profiler(PROFILE) if PROFILE not in ("", "0") else None
+
+# Opt-in timing of every GEGL node of GeglGraphs on Run, see profile_tree().
+# Takes the same values as BSZ_PROFILE, except a folder gets a nodes.log
+# and the graphs dumped into it. Separate from PROFILER, only for its output.
+PROFILE_NODES = os.environ.get("BSZ_PROFILE_NODES", "")
+if PROFILE_NODES in ("", "0"):
+    NODE_PROFILER = None
+elif os.path.isdir(PROFILE_NODES):
+    NODE_PROFILER = Profiler(os.path.join(PROFILE_NODES, "nodes.log"))
+else:
+    NODE_PROFILER = Profiler(PROFILE_NODES)
+
+
+def stage(name: str):
+    """Context manager timing its block as stage `name` when profiling,
+eg: `with stage("read pixels"):`. Does nothing otherwise."""
+    if PROFILER is None:
+        return contextlib.nullcontext()
+    return PROFILER.stage(name)
+
+
+def profile(name: str = None):
+    # {{{
+    """Decorator timing every call of a function as stage `name`,
+default the function's name. Leaves the function untouched when not
+profiling, so it costs nothing."""
+    def decorator(function):
+        if PROFILER is None:
+            return function
+        label = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with PROFILER.stage(label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+    # }}}
+
+
+def report(title: str, session: bool = False):
+    """Writes out the profiled stages if profiling. See Profiler.report()"""
+    if PROFILER is not None:
+        PROFILER.report(title, session)
+
+
+@profile("displays_flush")
+def displays_flush():
+    """Gimp.displays_flush() that does nothing outside of GIMP,
+where there aren't any displays."""
+    if Gimp.get_plug_in() is not None:
+        Gimp.displays_flush()
+
+
+def apply_shadow(drawable, shadow, x: int, y: int, width: int, height: int):
+    """Flushes `shadow`, merges it into `drawable` and updates the area
+x, y, width, height. Plugin functions finish with this once they've
+written the shadow, so each step is timed the same everywhere."""
+    with stage("shadow flush"):
+        shadow.flush()
+    with stage("merge_shadow"):
+        drawable.merge_shadow(True)
+    with stage("update"):
+        drawable.update(x, y, width, height)
+    displays_flush()
+
+
 GEGL_COMPOSITORS = {
     # {{{
     "Source": "svg:src",
@@ -92,6 +234,578 @@ GEGL_COMPOSITORS = {
 }  # }}}
 
 
+class PreviewCancelled(BaseException):
+    """Raised inside a preview that newer params have made pointless.
+BaseException so plugins' `except Exception` blocks let it through."""
+    pass
+
+
+def check_cancelled():
+    # {{{
+    """Raises PreviewCancelled if called from a preview that's been superseded
+by a newer request or a closed dialog. Does nothing outside of previews,
+so it's safe to sprinkle between chunks of work anywhere."""
+    thread = threading.current_thread()
+    if isinstance(thread, PreviewThread) and thread.superseded():
+        raise PreviewCancelled()
+    # }}}
+
+
+@profile("process")
+def process_node(node, rect: tuple = None):
+    # {{{
+    """Like node.process() but works in chunks, checking for cancelled previews
+between them. Use on the sink (usually write-buffer) node.
+`rect` limits it to an x, y, width, height area, like the selection's,
+instead of everything the graph produces."""
+    if rect is not None:
+        rect = Gegl.Rectangle.new(*rect)
+    processor = node.new_processor(rect)
+    while processor.work()[0]:
+        check_cancelled()
+    # }}}
+
+
+def buffer_tiles(buffer, x: int, y: int, width: int, height: int,
+                 tile_size: int = 512):
+    # {{{
+    """Yields Gegl.Rectangles covering the area x, y, width, height.
+Tile edges are snapped to the buffer's own tile grid, in blocks of roughly
+`tile_size` pixels square, so every get/set touches whole GEGL tiles and
+memory use is bounded by the block instead of the whole area.
+Checks for cancelled previews before each block."""
+    # GEGL's tiles are tiny (128x64 default) so group them into blocks,
+    # otherwise per-tile python overhead dominates.
+    step_w = max(1, tile_size // buffer.props.tile_width) \
+        * buffer.props.tile_width
+    step_h = max(1, tile_size // buffer.props.tile_height) \
+        * buffer.props.tile_height
+    # grid lines sit on multiples of the tile size once shifted
+    left = x - (x + buffer.props.shift_x) % step_w
+    top = y - (y + buffer.props.shift_y) % step_h
+
+    for row in range(top, y + height, step_h):
+        y1 = max(row, y)
+        y2 = min(row + step_h, y + height)
+        for col in range(left, x + width, step_w):
+            x1 = max(col, x)
+            x2 = min(col + step_w, x + width)
+            check_cancelled()
+            yield Gegl.Rectangle.new(x1, y1, x2 - x1, y2 - y1)
+    # }}}
+
+
+def buffer_bands(buffer, x: int, y: int, width: int, height: int,
+                 count: int):
+    # {{{
+    """Yields about `count` full-width Gegl.Rectangle bands covering the area
+x, y, width, height. Like buffer_tiles(), band edges are snapped to the
+buffer's tile rows, and previews are checked for cancellation."""
+    tile_h = buffer.props.tile_height
+    # round band height up to whole tile rows
+    step_h = max(1, -(-height // (count * tile_h))) * tile_h
+    top = y - (y + buffer.props.shift_y) % step_h
+
+    for row in range(top, y + height, step_h):
+        y1 = max(row, y)
+        y2 = min(row + step_h, y + height)
+        check_cancelled()
+        yield Gegl.Rectangle.new(x, y1, width, y2 - y1)
+    # }}}
+
+
+class GeglRectangle(ctypes.Structure):
+    _fields_ = [("x", ctypes.c_int), ("y", ctypes.c_int),
+                ("width", ctypes.c_int), ("height", ctypes.c_int)]
+
+
+def load_gegl_c():
+    # {{{
+    """Returns GEGL's and babl's shared libraries for ctypes, or None.
+PyGObject only hands out and takes immutable bytes, so going through it
+costs a copy into writable memory and another back out. The C functions
+read and write straight into ctypes memory instead.
+Needs PyGObject's __gpointer__ capsules to find the buffers behind the
+python wrappers."""
+    if not hasattr(Gegl.Buffer, "__gpointer__"):
+        return None
+    names = {"win32": ("libgegl-0.4-0", "libbabl-0.1-0")}
+    gegl_name, babl_name = names.get(sys.platform, ("gegl-0.4", "babl-0.1"))
+    gegl_path = ctypes.util.find_library(gegl_name)
+    babl_path = ctypes.util.find_library(babl_name)
+    if gegl_path is None or babl_path is None:
+        return None
+    try:
+        gegl = ctypes.CDLL(gegl_path)
+        babl = ctypes.CDLL(babl_path)
+        gegl.gegl_buffer_get.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(GeglRectangle), ctypes.c_double,
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+        gegl.gegl_buffer_get.restype = None
+        gegl.gegl_buffer_set.argtypes = [
+            ctypes.c_void_p, ctypes.POINTER(GeglRectangle), ctypes.c_int,
+            ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int]
+        gegl.gegl_buffer_set.restype = None
+        babl.babl_format.argtypes = [ctypes.c_char_p]
+        babl.babl_format.restype = ctypes.c_void_p
+        babl.babl_format_get_bytes_per_pixel.argtypes = [ctypes.c_void_p]
+        babl.babl_format_get_bytes_per_pixel.restype = ctypes.c_int
+        capsule = ctypes.pythonapi.PyCapsule_GetPointer
+        capsule.argtypes = [ctypes.py_object, ctypes.c_char_p]
+        capsule.restype = ctypes.c_void_p
+    except (OSError, AttributeError):
+        return None
+    return gegl, babl
+    # }}}
+
+
+# Opt-in, since a bad pointer takes the whole plug-in down with it.
+# Unset or 0 keeps to PyGObject's bytes.
+GEGL_C = load_gegl_c() \
+    if os.environ.get("BSZ_GEGL_C", "") not in ("", "0") else None
+
+
+def gobject_pointer(obj) -> int:
+    """Address of the C object behind a PyGObject wrapper,
+taken from the unnamed capsule it hands out as __gpointer__."""
+    return ctypes.pythonapi.PyCapsule_GetPointer(obj.__gpointer__, None)
+
+
+def map_buffer(buff, shadow, x: int, y: int, width: int, height: int,
+               babl_format: str, function: callable, tiled: bool = True,
+               tile_size: int = 512, workers: int = 1):
+    # {{{
+    """Runs function(pixels, rect) over the area x, y, width, height of buff
+then writes the results into shadow.
+`pixels` is a writable ctypes char array holding rect's pixels in
+babl_format. Edit it in place. It can go straight to FFI functions taking a
+char pointer, or be wrapped with memoryview/struct/numpy.frombuffer.
+If `tiled` the area is walked with buffer_tiles() using `tile_size`,
+reusing one allocation for every tile, otherwise it's done in one go for
+functions that need the whole area, like ones working out rows themselves.
+`workers` above 1 runs that many tiles at once on threads, each reusing its
+own allocation. Only worth it for functions that let go of the GIL, like
+ctypes calls into native code.
+Each block goes through PyGObject's bytes, copied in and back out once.
+With the environment variable BSZ_GEGL_C set, pixels are instead read into
+and written from that one allocation through GEGL's C API, see load_gegl_c()."""
+    if tiled:
+        rects = buffer_tiles(buff, x, y, width, height, tile_size)
+    else:
+        rects = [Gegl.Rectangle.new(x, y, width, height)]
+
+    if GEGL_C is not None:
+        gegl, babl = GEGL_C
+        fmt = babl.babl_format(babl_format.encode('UTF-8'))
+        bpp = babl.babl_format_get_bytes_per_pixel(fmt)
+        buff_c = gobject_pointer(buff)
+        shadow_c = gobject_pointer(shadow)
+
+    # one allocation per thread
+    local = threading.local()
+
+    def run(rect):
+        if GEGL_C is not None:
+            size = rect.width * rect.height * bpp
+        else:
+            with stage("buffer get"):
+                data = buff.get(rect, 1.0, babl_format,
+                                Gegl.AbyssPolicy.CLAMP)
+            size = len(data)
+        # grow only. edge tiles are smaller and reuse the same memory
+        memory = getattr(local, "memory", bytearray())
+        if len(memory) < size:
+            memory = local.memory = bytearray(size)
+        pixels = (ctypes.c_char * size).from_buffer(memory)
+
+        if GEGL_C is not None:
+            crect = GeglRectangle(rect.x, rect.y, rect.width, rect.height)
+            with stage("buffer get"):
+                # rowstride 0 is GEGL_AUTO_ROWSTRIDE
+                gegl.gegl_buffer_get(buff_c, crect, 1.0, fmt, pixels, 0,
+                                     int(Gegl.AbyssPolicy.CLAMP))
+        else:
+            # gegl hands out immutable bytes, so copy in instead of letting
+            # native code scribble over them
+            ctypes.memmove(pixels, data, size)
+            del data
+
+        with stage("map function"):
+            function(pixels, rect)
+
+        with stage("buffer set"):
+            if GEGL_C is not None:
+                gegl.gegl_buffer_set(shadow_c, crect, 0, fmt, pixels, 0)
+            else:
+                # pygobject only takes real bytes for the set
+                shadow.set(rect, babl_format, ctypes.string_at(pixels, size))
+        del pixels
+
+    if workers <= 1 or not tiled:
+        for rect in rects:
+            run(rect)
+        return
+
+    # a couple tiles queued per thread keeps them busy without holding
+    # much more than a tile each
+    pending = deque()
+    with ThreadPoolExecutor(workers) as pool:
+        try:
+            for rect in rects:
+                pending.append(pool.submit(run, rect))
+                while len(pending) >= workers * 2:
+                    pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        # also covers cancelled previews
+        finally:
+            for future in pending:
+                future.cancel()
+    # }}}
+
+
+class GeglTree():
+    # {{{
+    """One built GEGL graph, between an Input buffer-source and an Output
+write-buffer. Nodes are added by name with add(), then wired with regular
+Gegl.Node link()/connect_to().
+set() only pushes values that differ from last time, since every set_property
+throws away the cached results of that node and everything after it.
+`preview` marks trees kept for previews, which rerun as params change."""
+    def __init__(self, preview: bool = False):
+        self.preview = preview
+        self.tree = Gegl.Node()
+        self.nodes = {}
+        self.values = {}
+        self.Input = self.add("Input", "gegl:buffer-source")
+        self.Output = self.add("Output", "gegl:write-buffer")
+
+    def __getitem__(self, name: str):
+        return self.nodes[name]
+
+    def add(self, name: str, operation: str):
+        node = self.tree.create_child(operation)
+        # shows up in dumped graphs and GEGL's own debug output
+        node.set_property("name", name)
+        self.nodes[name] = node
+        return node
+
+    def set(self, name: str, key: str, value):
+        """Sets property `key` of node `name` if it changed.
+Key "operation" swaps the node's operation, keeping its links."""
+        if (name, key) in self.values and self.values[(name, key)] == value:
+            return
+        self.nodes[name].set_property(key, value)
+        if key == "operation":
+            # a new operation starts from its own defaults
+            for other in [k for k in self.values if k[0] == name]:
+                del self.values[other]
+        self.values[(name, key)] = value
+    # }}}
+
+
+def dump_tree(tree, folder: str, name: str):
+    # {{{
+    """Saves a GeglTree's input as `folder`/`name`.gegl and its graph as
+`folder`/`name`.xml reading from it, for replaying outside of GIMP with
+`gegl name.xml -o out.png`."""
+    path = os.path.join(folder, name)
+    buffer = tree.values[("Input", "buffer")]
+    graph = Gegl.Node()
+    Source = graph.create_child("gegl:buffer-source")
+    Source.set_property("buffer", buffer)
+    Save = graph.create_child("gegl:save")
+    Save.set_property("path", path + ".gegl")
+    Source.link(Save)
+    Save.process()
+
+    # a buffer doesn't serialize, so the input becomes a load just long
+    # enough to write the xml
+    tree.set("Input", "operation", "gegl:load")
+    tree.set("Input", "path", path + ".gegl")
+    try:
+        xml = tree.Output.get_producer("input")[0].to_xml(folder)
+    finally:
+        tree.set("Input", "operation", "gegl:buffer-source")
+        tree.set("Input", "buffer", buffer)
+    with open(path + ".xml", "w") as f:
+        f.write(xml)
+    # }}}
+
+
+def profile_tree(tree, rect: tuple, name: str):
+    # {{{
+    """Runs a GeglTree one node at a time over rect's x, y, width, height and
+reports each operation's time and GEGL's tile cache size after it, so it's
+clear whether the blur, the threshold, or the compositing dominates.
+Every node is set to always cache while this runs, so each only computes
+itself on top of its inputs' finished results. That's slower and hungrier
+than a normal run, hence a separate debug pass before the real one,
+and GeglGraph skips it for previews.
+Dumps the graph with dump_tree() too if PROFILE_NODES is a folder.
+GEGL_DEBUG_TIME=1 gets GEGL's own totals per operation instead."""
+    if os.path.isdir(PROFILE_NODES):
+        dump_tree(tree, PROFILE_NODES, name)
+
+    labels = {node: label for label, node in tree.nodes.items()}
+    # producers before their consumers. Output only writes the shadow
+    order = []
+
+    def visit(node):
+        if node not in order:
+            for pad in node.list_input_pads():
+                producer = node.get_producer(pad)[0]
+                if producer is not None:
+                    visit(producer)
+            order.append(node)
+    visit(tree.Output.get_producer("input")[0])
+
+    stats = Gegl.stats()
+    roi = Gegl.Rectangle.new(*rect)
+    rows = []
+    try:
+        for node in order:
+            # regular set_property goes to the operation, this is the node's
+            GObject.Object.set_property(node, "cache-policy",
+                                        Gegl.CachePolicy.ALWAYS)
+            start = time.perf_counter()
+            processor = node.new_processor(roi)
+            while processor.work()[0]:
+                check_cancelled()
+            rows.append((labels.get(node, "?"), node.get_operation(),
+                         time.perf_counter() - start,
+                         stats.props.tile_cache_total / 2**20))
+    finally:
+        for node in order:
+            GObject.Object.set_property(node, "cache-policy",
+                                        Gegl.CachePolicy.AUTO)
+
+    total = sum(row[2] for row in rows) or 1
+    width = max(len(row[0]) for row in rows)
+    op_width = max(len(row[1]) for row in rows)
+    lines = [f"{name} nodes", f"{'node':<{width}} {'operation':<{op_width}} "
+             f"{'seconds':>9} {'share':>6} {'cache MB':>9}"]
+    for label, operation, seconds, cache in rows:
+        lines.append(f"{label:<{width}} {operation:<{op_width}} "
+                     f"{seconds:>9.4f} {seconds / total:>6.1%} {cache:>9.1f}")
+    NODE_PROFILER.write("\n".join(lines))
+    # }}}
+
+
+class GeglGraph():
+    # {{{
+    """Plugin function made from a GEGL graph that's kept between calls,
+so previews only redo the nodes whose params changed.
+`build(tree)` adds the nodes to a fresh GeglTree once.
+`update(tree, rect, *params)` runs every call with the selection's
+x, y, width, height and pushes the params in using tree.set().
+On a ProxyDrawable that's the whole selection at proxy scale, not just the
+previewed region, so sizes taken from it match the final Run.
+Call it like any other plugin function, `graph(image, drawable, *params)`.
+Preview graphs are kept per drawable, since previews switch between proxies,
+and dropped with reset(). Anything else, like Run, builds a fresh graph
+that's let go of afterwards.
+`name` labels the graph in node profiles, see profile_tree()."""
+    def __init__(self, build: callable, update: callable,
+                 name: str = "graph"):
+        self.build = build
+        self.update = update
+        self.name = name
+        # proxies come and go with the preview region
+        self.trees = weakref.WeakKeyDictionary()
+
+    def __call__(self, image, drawable, *params):
+        # mask_intersect() is the current selection mask
+        intersect, x, y, width, height = drawable.mask_intersect()
+        if intersect:
+            Gegl.init(None)
+            # only previews run the same graph again
+            preview = isinstance(threading.current_thread(), PreviewThread)
+            tree = self.trees.get(drawable) if preview else None
+            if tree is None:
+                with stage("graph build"):
+                    tree = GeglTree(preview)
+                    self.build(tree)
+                if preview:
+                    self.trees[drawable] = tree
+
+            # a preview region still sizes things off the whole selection
+            selection = (x, y, width, height)
+            if isinstance(drawable, ProxyDrawable):
+                selection = drawable.selection_rect()
+
+            # the same buffer object keeps its cache. gegl notices if
+            # its contents change
+            with stage("graph update"):
+                tree.set("Input", "buffer", drawable.get_buffer())
+                shadow = drawable.get_shadow_buffer()
+                tree.set("Output", "buffer", shadow)
+                self.update(tree, selection, *params)
+
+            # not previews, which rerun on every change and scale
+            if NODE_PROFILER is not None and not preview:
+                profile_tree(tree, (x, y, width, height), self.name)
+
+            # Run the node tree, only over the selection or preview region
+            process_node(tree.Output, (x, y, width, height))
+
+            # Flush shadow buffer, combine it with main drawable
+            # and update everything
+            apply_shadow(drawable, shadow, x, y, width, height)
+
+    def reset(self):
+        """Drops every kept graph and with them GEGL's caches."""
+        self.trees.clear()
+    # }}}
+
+
+class Bind():
+    # {{{
+    """Value in a GeglSpec bound to the plugin param named `param`,
+or to several with a tuple of names.
+`transform(*values, rect)` converts the params' values first if given,
+with rect being the selection's x, y, width, height, see GeglGraph."""
+    def __init__(self, param, transform: callable = None):
+        if isinstance(param, str):
+            param = (param,)
+        self.params = tuple(param)
+        self.transform = transform
+
+    def __call__(self, values: dict, rect: tuple):
+        values = [values[param] for param in self.params]
+        if self.transform is not None:
+            return self.transform(*values, rect)
+        return values[0]
+    # }}}
+
+
+class GeglSpec(GeglGraph):
+    # {{{
+    """GeglGraph described as data instead of build/update functions.
+`nodes` maps node names to (operation, {property: value}). The operation and
+any value can be a Bind() to a param. Values can also be functions
+returning the value, called when the graph's built.
+`links` holds (source, target) or (source, target, pad) tuples, pad being
+"input" by default. The buffers are the nodes "Input" and "Output".
+`params` are the names of the function's params in order. PlugIn fills them
+in from its Params if left out.
+In preview graphs, nodes bound to params that branch, or feed into nodes
+bound to other params, get a gegl:cache after them, so a param only reruns
+what's downstream of it. Other graphs run once, so they aren't cached.
+`name` is as in GeglGraph."""
+    def __init__(self, nodes: dict, links: tuple, params: tuple = None,
+                 name: str = "graph"):
+        super().__init__(self.build_spec, self.update_spec, name)
+        self.nodes = nodes
+        self.links = [link if len(link) == 3 else (*link, "input")
+                      for link in links]
+        self.params = params
+
+        # params each node is bound to itself
+        self.bound = {"Input": set(), "Output": set()}
+        for name, (operation, props) in nodes.items():
+            values = [operation, *props.values()]
+            self.bound[name] = {param for value in values
+                                if isinstance(value, Bind)
+                                for param in value.params}
+        for link in self.links:
+            for name in link[:2]:
+                if name not in self.bound:
+                    raise ValueError("Link to unknown node " + name)
+
+        # params each node's output depends on, its own and upstream
+        self.depends = {}
+        for name in self.bound:
+            self.find_depends(name)
+
+        self.consumers = {}
+        for source, target, pad in self.links:
+            self.consumers.setdefault(source, set()).add(target)
+        # unbound nodes are fixed steps between bound ones, and every
+        # cache is a whole copy of the image, so only cache the bound
+        self.cached = [
+            name for name, targets in self.consumers.items()
+            if self.bound[name] and (len(targets) > 1 or any(
+                self.bound[target] - self.depends[name]
+                for target in self.next_bound(name)
+            ))
+        ]
+
+    def next_bound(self, name: str):
+        """Returns the first bound nodes downstream of node `name`."""
+        found = set()
+        for target in self.consumers.get(name, ()):
+            if self.bound[target]:
+                found.add(target)
+            else:
+                found |= self.next_bound(target)
+        return found
+
+    def find_depends(self, name: str, seen: tuple = ()):
+        if name not in self.depends:
+            if name in seen:
+                raise ValueError("Graph loops at node " + name)
+            depends = set(self.bound[name])
+            for source, target, pad in self.links:
+                if target == name:
+                    depends |= self.find_depends(source, seen + (name,))
+            self.depends[name] = depends
+        return self.depends[name]
+
+    def feeds(self, param: str):
+        """Returns the names of nodes that rerun when `param` changes."""
+        return [name for name, depends in self.depends.items()
+                if param in depends]
+
+    def build_spec(self, tree):
+        # a tree that only runs once would just hold image copies
+        cached = self.cached if tree.preview else []
+        for name, (operation, props) in self.nodes.items():
+            # bound operations are set on the first update, along with
+            # their constants. Links only connect to pads that exist,
+            # so use a stand-in that has them
+            if isinstance(operation, Bind):
+                pads = {pad for source, target, pad in self.links
+                        if target == name}
+                tree.add(name, "svg:src-over" if pads - {"input"}
+                         else "gegl:nop")
+            else:
+                self.set_constants(tree.add(name, operation), props)
+        for name in cached:
+            tree[name].link(tree.add(name + "_Cache", "gegl:cache"))
+        for source, target, pad in self.links:
+            if source in cached:
+                source += "_Cache"
+            if not tree[source].connect_to("output", tree[target], pad):
+                raise ValueError(f"Could not link {source} to the "
+                                 f"{pad} pad of {target}")
+
+    def set_constants(self, node, props: dict):
+        """Sets the props of `node` that aren't bound to params."""
+        for key, value in props.items():
+            if not isinstance(value, Bind):
+                # functions are for values that need GEGL started,
+                # like colors
+                if callable(value):
+                    value = value()
+                node.set_property(key, value)
+
+    def update_spec(self, tree, rect: tuple, *params):
+        values = dict(zip(self.params, params))
+        for name, (operation, props) in self.nodes.items():
+            # operation first, swapping it resets the properties
+            if isinstance(operation, Bind):
+                current = tree.values.get((name, "operation"))
+                tree.set(name, "operation", operation(values, rect))
+                # constants too, which are only set here for these nodes
+                if tree.values[(name, "operation")] != current:
+                    self.set_constants(tree[name], props)
+            for key, value in props.items():
+                if isinstance(value, Bind):
+                    tree.set(name, key, value(values, rect))
+    # }}}
+
+
 class Param(ABC):
     # {{{
     """Abstract class taken by PlugIn."""
@@ -130,6 +844,11 @@ Mostly used internally for widget property."""
 Mostly used internally for widget property."""
         pass
 
+    def parse(self, text: str):
+        """Converts command line text into a value for the param.
+Raises ValueError if it doesn't fit."""
+        return text
+
     def ui_reset(self):
         """Assuming ui_value properties are set up correctly,
 there's no reason to implement this differently on a class-by-class basis."""
@@ -176,6 +895,14 @@ class ParamBool(Param):
                                         ui_column, ui_row,
                                         ui_width, ui_height)
 
+    def parse(self, text: str):
+        text = text.lower()
+        if text in ("1", "true", "yes", "on"):
+            return True
+        if text in ("0", "false", "no", "off"):
+            return False
+        raise ValueError(f"{self.name} needs true or false, not '{text}'")
+
     def connect_changed(self, function, *args):
         self.widget.connect_changed(function, *args)
 
@@ -217,6 +944,15 @@ class ParamCombo(Param):
                                          ui_width, ui_height)
         self.dictionary = dictionary
 
+    def parse(self, text: str):
+        """Takes either the label or the value."""
+        if text in self.dictionary:
+            return self.dictionary[text]
+        if text in self.dictionary.values():
+            return text
+        raise ValueError(f"{self.name} needs one of " +
+                         ", ".join(self.dictionary))
+
     def connect_changed(self, function, *args):
         self.widget.connect_changed(function, *args)
 
@@ -252,13 +988,15 @@ class ParamCombo(Param):
 class ParamNumber(Param):
     # {{{
     """Creates a BSZGW Adjustment for numeric (float or int) parameters.
-AKA a cool slider"""
+AKA a cool slider.
+Set proxy_scale for sizes in pixels, so downscaled previews scale them too."""
     def __init__(self, name: str, value: int, min, max,
                  description: str = "", ui_preview: bool = True,
                  ui_column: int = 0, ui_row: int = 0,
                  ui_width: int = 1, ui_height: int = 1,
                  integer: bool = False,
-                 ui_step: int = 1, ui_logarithmic: bool = False):
+                 ui_step: int = 1, ui_logarithmic: bool = False,
+                 proxy_scale: bool = False):
         super(ParamNumber, self).__init__(name, value,
                                           description, ui_preview,
                                           ui_column, ui_row,
@@ -268,6 +1006,17 @@ AKA a cool slider"""
         self.integer = integer
         self.ui_step = ui_step
         self.ui_logarithmic = ui_logarithmic
+        # pixel sizes need shrinking along with downscaled previews
+        self.proxy_scale = proxy_scale
+
+    def parse(self, text: str):
+        value = float(text)
+        if not self.min <= value <= self.max:
+            raise ValueError(
+                f"{self.name} needs to be from {self.min} to {self.max}")
+        if self.integer:
+            value = round(value)
+        return value
 
     def connect_changed(self, function, *args):
         self.widget.connect_changed(function, *args)
@@ -323,6 +1072,9 @@ Currently only visually good for chaining across-columns."""
         self.param1 = param1
         self.param2 = param2
 
+    # linked or not, same as a ParamBool
+    parse = ParamBool.parse
+
     def create_widget(self):
         self.param1.widget.adjustment.connect(
             "value-changed", self.update, self.param1, self.param2)
@@ -413,46 +1165,382 @@ class ParamString(Param):
 
 class PreviewThread(threading.Thread):
     # {{{
-    """Runs `function` after self.request_preview has been called no more than
-once in the last 0.5 seconds."""
-    def __init__(self, function, *args):
+    """Runs `function` once request_preview() hasn't been called for `delay`
+seconds. Sleeps until a request comes in so idle dialogs cost nothing,
+and bursts of requests coalesce into a single run.
+A new request or stop() cancels the run in progress at its next
+check_cancelled(). Everything that previews should go through here, since
+runs of `function` are only kept from overlapping by this one thread."""
+    def __init__(self, function, *args, delay: float = 0.5):
         super(PreviewThread, self).__init__()
         self.function = function
         self.args = args
-        self.time = time.time()
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.time = time.monotonic()
         self.active = True
         self.request = True
+        # bumped every request. a run is stale once they stop matching
+        self.generation = 0
+        self.running = 0
+
+    def superseded(self):
+        """Whether the preview currently running is outdated."""
+        return not self.active or self.running != self.generation
 
     def run(self):
         """Thread's main loop. Not called directly, use thread.start()"""
-        while self.active:
-            time.sleep(0.1)
-            if time.time() - self.time > 0.5 and self.request:
-                self.function(*self.args)
-                self.time = time.time()
+        with self.condition:
+            while True:
+                while self.active and not self.request:
+                    self.condition.wait()
+                if not self.active:
+                    return
+                # wait out the quiet period. new requests push it back
+                remaining = self.time + self.delay - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
                 self.request = False
-
-    def request_preview(self, *args):
-        self.request = True
-        self.time = time.time()
+                self.running = self.generation
+                # unlocked while running so requests can still come in
+                self.condition.release()
+                try:
+                    self.function(*self.args)
+                except PreviewCancelled:
+                    pass
+                finally:
+                    self.condition.acquire()
+
+    def request_preview(self, *args, now: bool = False):
+        """Asks for a run once things go quiet, or right away if `now`."""
+        with self.condition:
+            self.request = True
+            self.generation += 1
+            self.time = time.monotonic()
+            if now:
+                self.time -= self.delay
+            self.condition.notify()
 
     def stop(self, *args):
-        self.active = False
+        with self.condition:
+            self.active = False
+            self.condition.notify()
         self.join()
     # }}}
 
 
+def guide_region(image, drawable, x: int, y: int, width: int, height: int):
+    # {{{
+    """Returns the part of x, y, width, height boxed in by the image's guides.
+The area is in `drawable`'s own coordinates, like mask_intersect() gives.
+The outermost vertical guides bound x, the outermost horizontal ones bound y.
+Axes with less than two guides, or areas missing the box, are left as is."""
+    guides = {Gimp.OrientationType.HORIZONTAL: [],
+              Gimp.OrientationType.VERTICAL: []}
+    # guides sit in image coordinates, so move them onto the drawable
+    _, off_x, off_y = drawable.get_offsets()
+    offsets = {Gimp.OrientationType.HORIZONTAL: off_y,
+               Gimp.OrientationType.VERTICAL: off_x}
+    guide = image.find_next_guide(0)
+    while guide:
+        orientation = image.get_guide_orientation(guide)
+        if orientation in guides:
+            guides[orientation].append(image.get_guide_position(guide)
+                                       - offsets[orientation])
+        guide = image.find_next_guide(guide)
+
+    x1, y1, x2, y2 = x, y, x + width, y + height
+    vertical = guides[Gimp.OrientationType.VERTICAL]
+    horizontal = guides[Gimp.OrientationType.HORIZONTAL]
+    if len(vertical) >= 2:
+        x1, x2 = max(x1, min(vertical)), min(x2, max(vertical))
+    if len(horizontal) >= 2:
+        y1, y2 = max(y1, min(horizontal)), min(y2, max(horizontal))
+
+    if x2 <= x1 or y2 <= y1:
+        return (x, y, width, height)
+    return (x1, y1, x2 - x1, y2 - y1)
+    # }}}
+
+
+def import_script(path: str, name: str):
+    # {{{
+    """Imports the plugin script at `path` as module `name` and returns it.
+The module's kept in sys.modules, so pickle finds its functions by name,
+and process pool workers can run this as their initializer to find them
+too. Only imports each name once per process."""
+    # gimp runs scripts as __main__, which spawned workers import themselves
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[name]
+            raise
+    return sys.modules[name]
+    # }}}
+
+
+class GeglDrawable():
+    # {{{
+    """Stand-in for a Gimp.Drawable backed by a plain Gegl.Buffer, so plugin
+functions can run from scripts without GIMP. The whole buffer counts as
+selected, and merge_shadow() copies the shadow over it like GIMP would.
+Use load() and save() to go through image files."""
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.shadow = None
+
+    @classmethod
+    def load(cls, path: str, babl_format: str = None):
+        """Loads any file gegl:load understands into a new GeglDrawable.
+Kept in the file's own pixel format unless `babl_format` is given, so bit
+depth and alpha come through to plugins and back out of save()."""
+        Gegl.init(None)
+        tree = Gegl.Node()
+        Load = tree.create_child("gegl:load")
+        Load.set_property("path", path)
+        extent = Load.get_bounding_box()
+        if extent.width < 1 or extent.height < 1:
+            raise ValueError(f"Could not load image '{path}'")
+
+        if babl_format is None:
+            # a cache stores whatever format its input hands it, and
+            # that's the loader's. Copied out so it's a plain buffer
+            Cache = tree.create_child("gegl:cache")
+            Load.link(Cache)
+            Cache.process()
+            cache = Cache.get_property("cache")
+            return cls(cache.create_sub_buffer(extent).dup())
+
+        buffer = Gegl.Buffer.new(babl_format, extent.x, extent.y,
+                                 extent.width, extent.height)
+        Output = tree.create_child("gegl:write-buffer")
+        Output.set_property("buffer", buffer)
+        Load.link(Output)
+        Output.process()
+        return cls(buffer)
+
+    def save(self, path: str):
+        """Saves with gegl:save, which picks the format from the extension."""
+        tree = Gegl.Node()
+        Input = tree.create_child("gegl:buffer-source")
+        Input.set_property("buffer", self.buffer)
+        Save = tree.create_child("gegl:save")
+        Save.set_property("path", path)
+        Input.link(Save)
+        Save.process()
+
+    def mask_intersect(self):
+        extent = self.buffer.get_extent()
+        return (True, extent.x, extent.y, extent.width, extent.height)
+
+    def get_buffer(self):
+        return self.buffer
+
+    def get_shadow_buffer(self):
+        # gegl copies on write, so the dup is cheap
+        if self.shadow is None:
+            self.shadow = self.buffer.dup()
+        return self.shadow
+
+    def merge_shadow(self, push_undo: bool):
+        extent = self.buffer.get_extent()
+        self.shadow.copy(extent, Gegl.AbyssPolicy.NONE, self.buffer, extent)
+
+    def update(self, x, y, width, height):
+        pass
+    # }}}
+
+
+class ProxyDrawable():
+    # {{{
+    """Stand-in for a Gimp.Drawable that renders previews of part of a drawable,
+possibly at lower resolution.
+Holds a copy of `source` under `rect`, default the drawable's mask intersect,
+downscaled by `scale`. Plugin functions run on it exactly like a drawable,
+then merge_shadow() scales the result back up into the real drawable,
+or into `overlay` if given, leaving the real drawable untouched.
+Its buffers are the same objects for its whole life, unlike a drawable's
+which are new every call, so graphs kept for it keep their caches."""
+    def __init__(self, drawable, source, scale: float, rect: tuple = None,
+                 overlay=None):
+        self.drawable = drawable
+        self.source = source
+        self.scale = scale
+        self.overlay = overlay
+        self.intersect, x, y, width, height = drawable.mask_intersect()
+        # only part of the intersect, so merge straight into the buffer
+        # since merging the shadow would blank everything outside rect
+        self.partial = rect is not None and rect != (x, y, width, height)
+        # the whole intersect at proxy scale, for params sized off of it
+        self.selection = (int(x * scale), int(y * scale),
+                          max(1, round(width * scale)),
+                          max(1, round(height * scale)))
+        if rect is None:
+            rect = (x, y, width, height)
+        self.rect = rect
+        x, y, width, height = rect
+        # scale-ratio scales around 0, 0, so the proxy lives at scaled coords
+        self.proxy_rect = (int(x * scale), int(y * scale),
+                           max(1, round(width * scale)),
+                           max(1, round(height * scale)))
+        self.shadow = None
+
+        Gegl.init(None)
+        # full size is only read, so there's nothing to copy
+        if scale == 1:
+            self.buffer = source
+            return
+
+        # a proxy is only for looking at, so plain float is precise enough
+        self.buffer = Gegl.Buffer.new("RGBA float", *self.proxy_rect)
+
+        tree = Gegl.Node()
+        Input = tree.create_child("gegl:buffer-source")
+        Input.set_property("buffer", source)
+        Crop = tree.create_child("gegl:crop")
+        for key, val in zip(("x", "y", "width", "height"), self.rect):
+            Crop.set_property(key, val)
+        Scale = tree.create_child("gegl:scale-ratio")
+        Scale.set_property("x", scale)
+        Scale.set_property("y", scale)
+        Output = tree.create_child("gegl:write-buffer")
+        Output.set_property("buffer", self.buffer)
+        Input.link(Crop)
+        Crop.link(Scale)
+        Scale.link(Output)
+        Output.process()
+
+    def mask_intersect(self):
+        return (self.intersect, *self.proxy_rect)
+
+    def selection_rect(self):
+        """The whole mask intersect scaled like the proxy, even when only
+a region of it is being previewed."""
+        return self.selection
+
+    def get_buffer(self):
+        return self.buffer
+
+    def get_shadow_buffer(self):
+        if self.shadow is None:
+            if self.scale == 1 and self.overlay is not None:
+                self.shadow = self.overlay.get_shadow_buffer()
+            elif self.scale == 1 and not self.partial:
+                self.shadow = self.drawable.get_shadow_buffer()
+            else:
+                self.shadow = Gegl.Buffer.new("RGBA float", *self.proxy_rect)
+        return self.shadow
+
+    def merge_shadow(self, push_undo: bool):
+        """Scales the shadow back up into the real drawable or overlay."""
+        # already the drawable's own shadow
+        if self.scale == 1 and self.overlay is None and not self.partial:
+            self.drawable.merge_shadow(push_undo)
+            return
+        tree = Gegl.Node()
+        Input = tree.create_child("gegl:buffer-source")
+        Input.set_property("buffer", self.get_shadow_buffer())
+        Scale = tree.create_child("gegl:scale-ratio")
+        Scale.set_property("x", 1 / self.scale)
+        Scale.set_property("y", 1 / self.scale)
+        Crop = tree.create_child("gegl:crop")
+        for key, val in zip(("x", "y", "width", "height"), self.rect):
+            Crop.set_property(key, val)
+        Input.link(Scale)
+        Scale.link(Crop)
+        Result = Crop
+
+        if self.overlay is not None:
+            target = self.overlay.get_buffer()
+            Result = self.select(tree, Crop)
+        elif self.partial:
+            # straight into the buffer skips merge_shadow's masking
+            target = self.drawable.get_buffer()
+            Result = self.select(tree, Crop)
+        else:
+            target = self.drawable.get_shadow_buffer()
+
+        Output = tree.create_child("gegl:write-buffer")
+        Output.set_property("buffer", target)
+        Result.link(Output)
+        Output.process()
+        target.flush()
+        if self.overlay is None and not self.partial:
+            self.drawable.merge_shadow(push_undo)
+
+    def select(self, tree, result):
+        """Fades `result` over the source by the image's selection,
+like merging a shadow would, for writes that don't go through one.
+Exact for opaque results, which covers anything but feathered edges
+of transparent ones."""
+        image = self.drawable.get_image()
+        if Gimp.Selection.is_empty(image):
+            return result
+        _, off_x, off_y = self.drawable.get_offsets()
+        Mask = tree.create_child("gegl:buffer-source")
+        Mask.set_property("buffer", image.get_selection().get_buffer())
+        # selection is in image coords, buffers are drawable local
+        Translate = tree.create_child("gegl:translate")
+        Translate.set_property("x", -off_x)
+        Translate.set_property("y", -off_y)
+        Fade = tree.create_child("gegl:opacity")
+        Source = tree.create_child("gegl:buffer-source")
+        Source.set_property("buffer", self.source)
+        Over = tree.create_child("gegl:over")
+        Crop = tree.create_child("gegl:crop")
+        for key, val in zip(("x", "y", "width", "height"), self.rect):
+            Crop.set_property(key, val)
+        Mask.link(Translate)
+        Translate.connect_to("output", Fade, "aux")
+        result.link(Fade)
+        Source.link(Over)
+        Fade.connect_to("output", Over, "aux")
+        Over.link(Crop)
+        return Crop
+
+    def update(self, x, y, width, height):
+        if self.overlay is not None:
+            self.overlay.update(*self.rect)
+        else:
+            self.drawable.update(*self.rect)
+    # }}}
+
+
+# Selections smaller than this, in pixels along the longest side,
+# are never previewed on a proxy
+PROXY_MIN_SIZE = 1024
+
+
 class PlugIn():
     # {{{
     """Automatically creates a gimp plugin UI from given Param classes.
 It's basically the old GimpFu but way cooler and more unstable.
 Check out one of my scripts that uses it and you'll instantly go
-\"ah it's like that\"."""
+\"ah it's like that\".
+preview_scale below 1 renders previews of large selections on a downscaled
+ProxyDrawable. Only Run works at full resolution.
+preview_scale may also be a tuple like (0.125, 0.5, 1), previewing at each
+scale in turn as long as the params aren't changed in the meantime.
+preview_delay is how long params must sit still before previewing.
+on_close is called once the plugin's done, after a run or a closed dialog,
+for freeing anything the function kept around between calls.
+graphs are the GeglGraphs reset when the dialog closes, for functions that
+pick between several. A GeglGraph function is reset on its own.
+Set the environment variable BSZ_PROFILE to get timings of every stage
+after each preview, run, and closed dialog. See Profiler for its values.
+BSZ_PROFILE_NODES times GEGL graph plugins node by node on Run,
+see profile_tree()."""
     # Get & save properties
     def __init__(self, name: str, function: callable, *params: Param,
                  description: str, alt_description: str = None,
-                 gegl_preview: bool = True,
-                 procedure_name: str = None, images: str = "RGB*",
+                 gegl_preview: bool = True, preview_scale=1.0,
+                 preview_delay: float = 0.5, on_close: callable = None,
+                 graphs: tuple = (), procedure_name: str = None, images: str = "RGB*",
                  path: str = "<Image>/Beinsezii/", icon=GimpUi.ICON_GEGL,
                  authors: str = "Beinsezii", copyright: str = None,
                  date: str = "2020"):
@@ -540,9 +1628,29 @@ and looks nicer I'll replace it ASAP."""
         self.name = name
         self.function = function
         self.params = params
+        # specs take values in the same order as ui_vals()
+        if isinstance(function, GeglSpec) and function.params is None:
+            function.params = tuple(
+                param.name for param in params
+                if not isinstance(param, ParamNumberChain))
         self.gegl_preview = gegl_preview
+        if isinstance(preview_scale, (int, float)):
+            preview_scale = (preview_scale,)
+        self.preview_scales = tuple(preview_scale)
+        self.preview_delay = preview_delay
+        self.on_close = on_close
+        self.graphs = tuple(graphs)
+        if isinstance(function, GeglGraph) and function not in self.graphs:
+            self.graphs += (function,)
         # }}}
 
+    def values(self, overrides: dict = {}) -> list:
+        """Returns the params' default values in the order the function takes
+them, with `overrides` replacing any by param name."""
+        return [overrides.get(param.name, param.value)
+                for param in self.params
+                if not isinstance(param, ParamNumberChain)]
+
     # I decided to name the function called by the PDB procedure 'run'
     def run(self, procedure, run_mode, image, n_drawables, drawables, config, run_data):
         # convert the ValueArray into a regular list
@@ -565,7 +1673,9 @@ and looks nicer I'll replace it ASAP."""
 
         # run_mode 'NONINTERACTIVE' is if another plugin calls it through PDB
         if run_mode == Gimp.RunMode.NONINTERACTIVE:
-            self.function(image, drawable, **config)
+            with stage("function"):
+                self.function(image, drawable, **config)
+            report(self.name)
 
         # run_mode 'WITH_LAST_VALS' is when you use Ctrl-F aka 'Repeat'
         # seems the gimp shelf isn't implemented yet?
@@ -579,12 +1689,19 @@ and looks nicer I'll replace it ASAP."""
         if run_mode == Gimp.RunMode.INTERACTIVE:
             # puts all ui params into a list
             # ignors ui-specific params like chains
-            def ui_vals():
+            # scale is for proxy previews
+            def ui_vals(scale=1):
                 # {{{
                 vals = []
                 for param in self.params:
                     if not isinstance(param, ParamNumberChain):
-                        vals.append(param.ui_value)
+                        value = param.ui_value
+                        if scale != 1 and isinstance(param, ParamNumber) \
+                                and param.proxy_scale:
+                            value *= scale
+                            if param.integer:
+                                value = round(value)
+                        vals.append(value)
                 return vals
                 # }}}
 
@@ -595,9 +1712,11 @@ and looks nicer I'll replace it ASAP."""
                 preview_thread.stop()
                 clear_preview()
                 image.undo_group_start()
-                self.function(image, drawable,
-                              *ui_vals())
+                with stage("run"):
+                    self.function(image, drawable,
+                                  *ui_vals())
                 image.undo_group_end()
+                report(self.name + " run")
                 app.destroy()
                 # }}}
             run_button = bszgw.Button("Run", run_fn)
@@ -608,15 +1727,86 @@ and looks nicer I'll replace it ASAP."""
             reset_button = bszgw.Button("Reset", reset_fn)
 
             Gegl.init(None)
-            self.buffer = drawable.get_buffer().dup()
+            # layers preview on a copy stacked over them, so the drawable
+            # itself is never written until Run. Anything else, like masks
+            # and channels, previews in place and gets restored from a copy
+            overlay_preview = drawable.is_layer()
+            with stage("buffer dup"):
+                if overlay_preview:
+                    self.buffer = drawable.get_buffer()
+                else:
+                    self.buffer = drawable.get_buffer().dup()
+            self.overlay = None
+            self.visible = drawable.get_visible()
             self.has_preview = False
             self.flush = False
+            # stand-ins, built on first use and kept for the
+            # dialog's lifetime
+            self.proxies = {}
+
+            # returns the drawables previews should render on, coarsest
+            # first, each paired with its scale
+            def preview_drawables():
+                # {{{
+                intersect, x, y, width, height = drawable.mask_intersect()
+                rect = (x, y, width, height)
+                if region_check.value:
+                    rect = guide_region(image, drawable, *rect)
+                longest = max(rect[2], rect[3], 1)
+                scales = []
+                for scale in sorted(self.preview_scales):
+                    scale = min(1, max(scale, PROXY_MIN_SIZE / longest))
+                    if scale not in scales:
+                        scales.append(scale)
+
+                # guides moved, old regions won't come back
+                if any(key[1] != rect for key in self.proxies):
+                    self.proxies = {}
+                    # and their previews shouldn't linger on the overlay
+                    if self.overlay is not None:
+                        clear_preview()
+                        show_overlay()
+                # generator so proxies are only built once they're reached.
+                # full res in place goes through one too, reading the copy,
+                # as the drawable's own buffers are new objects every call
+                for scale in scales:
+                    key = (scale, rect)
+                    if key not in self.proxies:
+                        with stage("proxy"):
+                            self.proxies[key] = ProxyDrawable(
+                                drawable, self.buffer, scale, rect,
+                                self.overlay)
+                    yield self.proxies[key], scale
+                # }}}
 
-            # if any preview layers, delete them and thaw
-            # TODO: hide base layers when preview is up
+            # stacks a copy of the drawable over it for previews to render
+            # into, hiding the original
+            @profile("show_overlay")
+            def show_overlay():
+                # {{{
+                if self.overlay is None:
+                    image.undo_freeze()
+                    self.overlay = Gimp.Layer.new_from_drawable(drawable, image)
+                    self.overlay.set_name(self.name + " Preview")
+                    image.insert_layer(self.overlay, drawable.get_parent(),
+                                       image.get_item_position(drawable))
+                    drawable.set_visible(False)
+                    # old proxies merge into the old overlay
+                    self.proxies = {}
+                # }}}
+
+            # removes the overlay, or restores the drawable if previewed
+            # in place, and thaws
+            @profile("clear_preview")
             def clear_preview(*args):
                 # {{{
-                if self.has_preview:
+                if self.overlay is not None:
+                    image.remove_layer(self.overlay)
+                    drawable.set_visible(self.visible)
+                    self.overlay = None
+                    self.proxies = {}
+                    displays_flush()
+                elif self.has_preview:
                     # self.drawable.buffer = self.buffer
                     intersect, x, y, width, height = drawable.mask_intersect()
                     if intersect:
@@ -632,31 +1822,59 @@ and looks nicer I'll replace it ASAP."""
                         if self.flush:
                             target.flush()
                         drawable.update(x, y, width, height)
-                        Gimp.displays_flush()
+                        displays_flush()
                         self.has_preview = False
                 while not image.undo_is_enabled():
                     image.undo_thaw()
                 # }}}
 
-            # if preview function, get new preview layer[s] from
-            # self.preview_function and add them to self.preview_layers
+            # if preview function, render it on the overlay, or in place
+            # over the restored drawable
             def preview_fn(*args):
                 # {{{
                 if self.gegl_preview:
-                    clear_preview()
-                    if preview_check.value:
-                        image.undo_freeze()
-                        self.function(image, drawable, *ui_vals())
-                        self.has_preview = True
+                    # reported even when cancelled, so each report is
+                    # one preview
+                    try:
+                        # each overlay update overwrites the last one,
+                        # so it only goes away with the preview
+                        if not overlay_preview or not preview_check.value:
+                            clear_preview()
+                        if preview_check.value:
+                            if overlay_preview:
+                                show_overlay()
+                            # progressively refines until a newer request
+                            # cancels it
+                            for num, (target, scale) in enumerate(
+                                    preview_drawables()):
+                                if num > 0:
+                                    check_cancelled()
+                                if not overlay_preview:
+                                    image.undo_freeze()
+                                    # set first, a cancelled preview may have
+                                    # written part of the drawable already
+                                    self.has_preview = True
+                                with stage(f"preview x{scale:g}"):
+                                    self.function(image, target,
+                                                  *ui_vals(scale))
+                    finally:
+                        report(self.name + " preview")
                 # }}}
 
             # creates preview_check, starts the live preview thread,
             # and has the widgets connect to function
-            preview_thread = PreviewThread(preview_fn)
+            preview_thread = PreviewThread(preview_fn,
+                                           delay=self.preview_delay)
             preview_thread.start()
+
+            # buttons skip the delay, but still run on the preview thread
+            # so two previews can't stack overlays at once
+            def preview_now(*args):
+                preview_thread.request_preview(now=True)
+
             if self.gegl_preview:
                 # {{{
-                preview_button = bszgw.Button("Update", preview_fn)
+                preview_button = bszgw.Button("Update", preview_now)
                 preview_button.props.hexpand = True
 
                 preview_check = bszgw.CheckButton("Preview", True)
@@ -664,13 +1882,19 @@ and looks nicer I'll replace it ASAP."""
                 def onclick(*args):
                     self.flush = not preview_check.value
                 preview_check.connect("clicked", onclick)
-                preview_check.connect("clicked", preview_fn)
+                preview_check.connect("clicked", preview_now)
+
+                region_check = bszgw.CheckButton("Region", False)
+                region_check.props.tooltip_text = \
+                    "Only preview the area boxed in by the image's guides"
+                region_check.connect("clicked", preview_now)
                 for param in self.params:
                     param.connect_preview(preview_thread.request_preview)
                 # }}}
             else:
                 preview_button = None
                 preview_check = None
+                region_check = None
 
             # creates buttons box to avoid attaching buttons directly.
             # reduces buggery with grid attach widths.
@@ -698,11 +1922,13 @@ and looks nicer I'll replace it ASAP."""
             buttons.props.column_homogeneous = True
             if max_off > 0 and self.gegl_preview:
                 buttons.attach_all_right(preview_button, preview_check,
-                                         reset_button, run_button)
+                                         region_check, reset_button,
+                                         run_button)
                 if self.gegl_preview:
                     buttons = GC(buttons, col_off=max_off - 2, width=3)
             else:
-                buttons.attach_all_right(preview_button, preview_check)
+                buttons.attach_all_right(preview_button, preview_check,
+                                         region_check)
                 buttons.attach_all_right(reset_button, run_button, row=1)
 
             grid.attach_all_down(*children, buttons)
@@ -717,11 +1943,18 @@ and looks nicer I'll replace it ASAP."""
                 preview_thread.stop()
                 self.flush = True
                 clear_preview()
+                # graphs cache every node, which adds up on big images
+                for graph in self.graphs:
+                    graph.reset()
+                report(self.name + " dialog total", session=True)
             app.connect("destroy", destroy_fn)
 
             # create preview before start
             app.launch()
 
+        if self.on_close is not None:
+            self.on_close()
+
         # Don't actually really know what this does but seems important
         return procedure.new_return_values(
             Gimp.PDBStatusType.SUCCESS, GLib.Error())
@@ -12,6 +12,7 @@ zip -q bsz-gimp-plugins_${date}.zip \
     pixelbuster.dll \
     bsz-*/bsz-*.py \
     bsz-*/*.dll \
-    bsz-*/*.so
+    bsz-*/*.so \
+    bsz-*/gegl/*.so
 
 git tag ${date}
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Checks Dual Bloom's Fast blur mode stays close to the exact blur,
+and its fused graph for equal sizes matches the split one. Runs them on the
+benchmark's synthetic image with headless GEGL, so it needs GIMP's and
+GEGL's typelibs but not a running GIMP.
+
+$ python3 -m pytest tests
+"""
+
+import array
+import os.path
+import sys
+
+import pytest
+
+gi = pytest.importorskip("gi")
+try:
+    gi.require_version('Gimp', '3.0')
+    gi.require_version('Gegl', '0.4')
+except ValueError:
+    pytest.skip("needs GIMP's and GEGL's typelibs", allow_module_level=True)
+from gi.repository import Gegl  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "benchmarks"))
+from benchmark import make_buffer  # noqa: E402
+from bsz_gimp_batch import load_plugin  # noqa: E402
+from bsz_gimp_lib import GeglDrawable  # noqa: E402
+
+PLUGIN = os.path.join(ROOT, "bsz-dualbloom", "bsz-dualbloom.py")
+
+# Fast only differs past FAST_SIZE, so these blurs are well over it
+# on the test image. Equal sizes take the fused graph, unequal the split.
+SIZES = {
+    "fused": {"Blur Size High": 10, "Blur Size Low": 10},
+    "split": {"Blur Size High": 10, "Blur Size Low": 5},
+}
+
+# Largest and mean difference allowed per channel, on a 0-1 scale.
+# A pure python model of both blurs on this image, with box downscaling and
+# bilinear upscaling, differs by at most 0.0017, and 0.00013 on average.
+# GEGL's samplers aren't modeled, so these leave about 5x that for them.
+MAX_DIFF = 0.01
+MEAN_DIFF = 0.001
+
+# The fused graph blurs both masks packed into one buffer, which is the same
+# linear math as blurring each on its own, so only rounding should differ.
+FUSED_MAX_DIFF = 0.001
+FUSED_MEAN_DIFF = 0.0001
+
+
+def render(overrides: dict, function: callable = None) -> array.array:
+    """Runs Dual Bloom, or one of its graphs as `function`, on a fresh
+synthetic image, returning its pixels as RGBA floats."""
+    plugin = load_plugin(PLUGIN).plugin
+    Gegl.init(None)
+    drawable = GeglDrawable(make_buffer(0.25, "RGBA float"))
+    (function or plugin.function)(None, drawable, *plugin.values(overrides))
+    rect = drawable.get_buffer().get_extent()
+    return array.array("f", drawable.get_buffer().get(
+        rect, 1.0, "RGBA float", Gegl.AbyssPolicy.CLAMP))
+
+
+def difference(name: str, a: array.array, b: array.array) -> tuple:
+    """Returns the largest and mean difference between two renders."""
+    assert len(a) == len(b)
+    diffs = [abs(x - y) for x, y in zip(a, b)]
+    largest, mean = max(diffs), sum(diffs) / len(diffs)
+    # shown with -s, for retuning the limits
+    print(f"{name}: largest {largest:.5f}, mean {mean:.6f}")
+    return largest, mean
+
+
+@pytest.mark.parametrize("graph", SIZES)
+def test_fast_matches_exact(graph):
+    exact = render({**SIZES[graph], "Blur Mode": "exact"})
+    fast = render({**SIZES[graph], "Blur Mode": "fast"})
+    largest, mean = difference(graph, exact, fast)
+    assert largest < MAX_DIFF
+    assert mean < MEAN_DIFF
+
+
+@pytest.mark.parametrize("mode", ("exact", "fast"))
+def test_fused_matches_split(mode):
+    module = load_plugin(PLUGIN)
+    overrides = {**SIZES["fused"], "Blur Mode": mode}
+    fused = render(overrides, module.dual_bloom_fused)
+    split = render(overrides, module.dual_bloom_split)
+    largest, mean = difference("fused " + mode, fused, split)
+    assert largest < FUSED_MAX_DIFF
+    assert mean < FUSED_MEAN_DIFF